@@ -1,7 +1,33 @@
 export wechat_token=WECHAT_ACCOUNT_TOKEN
 export chat_gpt_token=YOUR_CHATGPT_TOKEN
 export token=A_TOKEN_USED_TO_MANAGE_THE_SERVER
+# optional, a comma separated list of proxies is used as a health-checked pool
 export http_proxy=AN_OPTIONAL_HTTP_PROXY
 export admin_user_ids=ADMIN_USER_IDS_SPLI_BY_COMMA
 export white_list_user_ids=WHITELIST_USER_IDS_SPLI_BY_COMMA
-export admin_email=ADMIN_EMAIL_ADDRESS
\ No newline at end of file
+export admin_email=ADMIN_EMAIL_ADDRESS
+export max_upstream_concurrency=8
+
+# optional, json list of routes tried in order, e.g. [{"model": "gpt-4", "max_tokens": 512, "tokens_per_second": 10}, {"model": "gpt-3.5-turbo", "max_tokens": 1024}]
+export model_routes=
+# optional, answer first-turn questions similar to a previous one from a local cache, e.g. /app/data/semantic-cache
+export semantic_cache_dir=
+export semantic_cache_size=10000
+export semantic_cache_threshold=0.9
+# optional, wait this long for more messages from a user before asking, so that consecutive messages are answered at once
+export merge_window_ms=0
+# optional, json rules to answer blocked and trivial messages locally, reloaded on change, e.g. /app/data/prefilter.json
+# {"blocked_words": ["..."], "blocked_reply": "...", "canned_replies": {"你好": "你好！有什么可以帮您？"}, "trivial_msg_reply": "[微笑]"}
+export prefilter_path=
+# optional, record tokens of every OpenAI call, e.g. /app/data/ledger, and limit the tokens per user per day
+export ledger_dir=
+export user_tokens_per_day=
+# optional, record anonymized requests and OpenAI call latencies for `python -m wechatgpt.replay`, e.g. /app/data/capture.jsonl
+export traffic_capture_path=
+# keep message texts in the capture, they are replaced by placeholders by default
+export traffic_capture_plaintext=false
+# optional, keep chat sessions, chat stats and recent answers over `make deploy`, e.g. /app/data/snapshot.json
+export snapshot_path=
+# optional, retry failed questions in the background, e.g. /app/data/retry-queue.db
+export retry_queue_path=
+export max_retry_workers=2
@@ -1,13 +1,19 @@
-import hashlib
 import json
 import math
 import time
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
 import requests
 
+from .ledger import TokenLedger
 from .logger import get_logger
+from .metrics import get_metrics
+from .proxy_pool import ProxyPool
+from .request_context import request_elapsed_seconds
+from .router import ModelRouter
+from .tracing import get_tracer
+from .traffic import TrafficRecorder, hash_user_id
 
 
 class ChatMessage:
@@ -79,6 +85,12 @@ class UserChats:
     def add_user_chat(self, user: str, content: str):
         return self._add_chat(user, "user", content)
 
+    def remove_last_user_chat(self, user: str, content: str):
+        """Removes the question of a failed answer, so that the session doesn't keep a question without answer."""
+        msgs = self.chats.get(user)
+        if msgs and msgs[-1].role == "user" and msgs[-1].content == content:
+            msgs.pop()
+
     def _add_chat(
         self,
         user: str,
@@ -103,9 +115,25 @@ class UserChats:
         msgs = [m.as_gpt_msg() for m in self.chats[user]]
         return msgs
 
+    def to_snapshot(self) -> dict:
+        # sessions only, the initial messages come from the code
+        skip = len(self.initial_msgs)
+        return {
+            "chats": {user: [[m.role, m.content, m.at] for m in chats[skip:]] for user, chats in list(self.chats.items()) if len(chats) > skip},
+            "chat_tokens": {user: tokens for user, tokens in list(self.chat_tokens.items()) if tokens},
+        }
+
+    def load_snapshot(self, data: dict):
+        chats = {user: self.initial_msgs + [ChatMessage(role, content, at) for role, content, at in msgs] for user, msgs in data["chats"].items()}
+        self.chats, self.chat_tokens = chats, {user: data["chat_tokens"].get(user, 0) for user in chats}
+
+
+class BusyError(Exception):
+    """Raised when a question is not answered because the upstream is saturated, `args[0]` is the reply to the user."""
+
 
 class Bot:
-    def answer(self, user: str, question: str) -> str:
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
         raise NotImplementedError()
 
 
@@ -114,42 +142,85 @@ class ChatgptBot(Bot):
         self,
         token: str,
         chats: UserChats,
-        proxy: Optional[str] = None,
+        proxy: Optional[Union[str, ProxyPool]] = None,
         max_tokens: Optional[int] = None,
+        router: Optional[ModelRouter] = None,
+        ledger: Optional[TokenLedger] = None,
+        url: str = "https://api.openai.com/v1/chat/completions",
+        recorder: Optional[TrafficRecorder] = None,
+        timeout_seconds: float = 120,
     ) -> None:
         # get your token from: https://platform.openai.com/account/api-keys
         self.token = token
-        self.url = "https://api.openai.com/v1/chat/completions"
+        self.url = url
         self.chats = chats
         self.proxy = proxy
         self.max_tokens = max_tokens
+        # without routes, every question goes to gpt-3.5-turbo, limited only by `max_tokens` if set
+        self.router = router
+        self.ledger = ledger
+        self.recorder = recorder
+        # connecting is given as long as the proxy health probes, generating the answer up to `timeout_seconds`
+        connect_timeout_seconds = proxy.probe_timeout_seconds if isinstance(proxy, ProxyPool) else 5
+        self.timeout = (connect_timeout_seconds, timeout_seconds)
         self.token_exceeded_msg = "抱歉，这个话题我们已经聊了太多了。我没法再聊下去了。或许您可以总结一下前面的内容，然后我们再尝试往下聊！"
         self.system_error_msg = "抱歉，系统错误，请稍候再试！"
+        self.truncated_hint = "\n\n（回答长度已达上限，回复“继续”查看后续内容）"
 
     def _user_id(self, user: str) -> str:
-        md5 = hashlib.md5()
-        md5.update(user.encode())
-        return md5.hexdigest()
+        return hash_user_id(user)
+
+    def _record_upstream(self, user: str, started_at: float, status_code: Optional[int], completion_tokens: int = 0):
+        if self.recorder is not None:
+            self.recorder.record_upstream(user, time.time() - started_at, status_code, completion_tokens)
 
-    def answer(self, user: str, question: str) -> str:
+    def _report_proxy(self, proxy: Optional[str], ok: bool):
+        if not isinstance(self.proxy, ProxyPool) or proxy is None:
+            return
+        if ok:
+            self.proxy.report_success(proxy)
+        else:
+            self.proxy.report_failure(proxy)
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
         self.chats.try_clear_session_chats()
         self.chats.add_user_chat(user, question)
         msgs = self.chats.to_gpt_chats(user)
-        data = {"model": "gpt-3.5-turbo", "user": self._user_id(user), "messages": msgs}
-        if self.max_tokens:
-            data["max_tokens"] = self.max_tokens
+        model = "gpt-3.5-turbo"
+        max_tokens = max_tokens or self.max_tokens
+        if self.router is not None:
+            # wechat's reply window started with the request, time spent waiting for more messages or an upstream slot is gone
+            route = self.router.route(msgs, request_elapsed_seconds(), max_tokens)
+            model, max_tokens = route.model, route.max_tokens
+        data = {"model": model, "user": self._user_id(user), "messages": msgs}
+        if max_tokens:
+            data["max_tokens"] = max_tokens
         get_logger().info(f"send question for user {user} (hash: {data['user']}) to gpt: {question}")
-        proxies = {"http": self.proxy, "https": self.proxy} if self.proxy is not None else None
-        r = requests.post(
-            self.url,
-            json=data,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.token,
-            },
-            proxies=proxies,
-        )
+        proxy = self.proxy.select() if isinstance(self.proxy, ProxyPool) else self.proxy
+        proxies = {"http": proxy, "https": proxy} if proxy is not None else None
+        started_at = time.time()
+        try:
+            with get_tracer().span("upstream"):
+                r = requests.post(
+                    self.url,
+                    json=data,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Authorization": "Bearer " + self.token,
+                    },
+                    proxies=proxies,
+                    timeout=self.timeout,
+                )
+        except requests.RequestException:
+            self._report_proxy(proxy, ok=False)
+            self._record_upstream(user, started_at, None)
+            self.chats.remove_last_user_chat(user, question)
+            raise
+        # these are what a proxy answers when it can't reach the upstream
+        self._report_proxy(proxy, ok=r.status_code not in (407, 502, 504))
         if r.status_code != 200:
+            self._record_upstream(user, started_at, r.status_code)
+            self.chats.remove_last_user_chat(user, question)
             response_text = r.text
             get_logger().error(f"Found error: status={r.status_code}, body={response_text}")
             if r.status_code == 400:
@@ -169,9 +240,21 @@ class ChatgptBot(Bot):
             resp = r.json()
             get_logger().info(f"got response from gpt: {json.dumps(resp, ensure_ascii=False)}")
             total_tokens = resp["usage"]["total_tokens"]
+            latency = time.time() - started_at
+            completion_tokens = resp["usage"].get("completion_tokens", 0)
+            if self.router is not None:
+                self.router.observe(model, completion_tokens, latency)
+            self._record_upstream(user, started_at, r.status_code, completion_tokens)
+            if self.ledger is not None:
+                self.ledger.record(user, model, resp["usage"].get("prompt_tokens", total_tokens - completion_tokens), completion_tokens, latency)
             message = resp["choices"][0]["message"]["content"]
             self.chats.add_assistant_chat(user, message, total_tokens)
+            if resp["choices"][0].get("finish_reason") == "length":
+                # the cut answer stays in the session, so that asking to go on continues it
+                get_metrics().incr("bot.truncated_answers")
+                return message + self.truncated_hint
             return message
         except:
             get_logger().error(f"Unable to parse response: status={r.status_code}, body={r.text}")
+            self.chats.remove_last_user_chat(user, question)
             return self.system_error_msg
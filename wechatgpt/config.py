@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Callable, List, Mapping, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class ConfigError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ServerConfig:
+    REQUIRED_KEYS = ["chat_gpt_token", "token", "wechat_token", "admin_user_ids", "admin_email"]
+
+    def __init__(
+        self,
+        chat_gpt_token: str,
+        token: str,
+        wechat_token: str,
+        admin_user_ids: List[str],
+        admin_email: str,
+        white_list_user_ids: Optional[List[str]] = None,
+        http_proxy: Optional[str] = None,
+        max_upstream_concurrency: int = 8,
+        model_routes: Optional[str] = None,
+        semantic_cache_dir: Optional[str] = None,
+        semantic_cache_size: int = 10000,
+        semantic_cache_threshold: float = 0.9,
+        merge_window_ms: int = 0,
+        prefilter_path: Optional[str] = None,
+        ledger_dir: Optional[str] = None,
+        user_tokens_per_day: Optional[int] = None,
+        chat_gpt_url: str = "https://api.openai.com/v1/chat/completions",
+        traffic_capture_path: Optional[str] = None,
+        traffic_capture_plaintext: bool = False,
+        snapshot_path: Optional[str] = None,
+        retry_queue_path: Optional[str] = None,
+        max_retry_workers: int = 2,
+    ) -> None:
+        self.chat_gpt_token = chat_gpt_token
+        self.token = token
+        self.wechat_token = wechat_token
+        self.admin_user_ids = admin_user_ids
+        self.admin_email = admin_email
+        self.white_list_user_ids = white_list_user_ids or []
+        # a comma separated list of proxies is used as a health-checked pool
+        self.http_proxy = http_proxy
+        self.http_proxies = [p.strip() for p in (http_proxy or "").split(",") if p.strip()]
+        self.max_upstream_concurrency = max_upstream_concurrency
+        self.model_routes = model_routes
+        self.semantic_cache_dir = semantic_cache_dir
+        self.semantic_cache_size = semantic_cache_size
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self.merge_window_ms = merge_window_ms
+        self.prefilter_path = prefilter_path
+        self.ledger_dir = ledger_dir
+        self.user_tokens_per_day = user_tokens_per_day
+        self.chat_gpt_url = chat_gpt_url
+        self.traffic_capture_path = traffic_capture_path
+        # message texts are replaced in the capture by placeholders of the same length, unless asked to keep them
+        self.traffic_capture_plaintext = traffic_capture_plaintext
+        # sessions, chat stats and recent answers are written here on drain and exit, and restored on start
+        self.snapshot_path = snapshot_path
+        # a sqlite file of failed questions, retried in the background
+        self.retry_queue_path = retry_queue_path
+        self.max_retry_workers = max_retry_workers
+
+    @staticmethod
+    def from_env(environ: Optional[Mapping[str, str]] = None) -> ServerConfig:
+        """Reads the config from environment variables. All problems are reported at once in a `ConfigError`."""
+        env = os.environ if environ is None else environ
+        errors = [f"missing required config: {key}" for key in ServerConfig.REQUIRED_KEYS if not env.get(key, "").strip()]
+
+        def parse(key: str, parser: Callable[[str], T], default: T) -> T:
+            value = env.get(key, "").strip()
+            if not value:
+                return default
+            try:
+                return parser(value)
+            except ValueError as e:
+                errors.append(f"invalid config {key}={value}: {e}")
+                return default
+
+        def parse_bool(value: str) -> bool:
+            if value.lower() not in ("true", "false", "1", "0"):
+                raise ValueError("expect true or false")
+            return value.lower() in ("true", "1")
+
+        def split_ids(value: str) -> List[str]:
+            return [v.strip() for v in value.split(",") if v.strip()]
+
+        config = ServerConfig(
+            chat_gpt_token=env.get("chat_gpt_token", ""),
+            token=env.get("token", ""),
+            wechat_token=env.get("wechat_token", ""),
+            admin_user_ids=split_ids(env.get("admin_user_ids", "")),
+            admin_email=env.get("admin_email", ""),
+            white_list_user_ids=split_ids(env.get("white_list_user_ids", "")),
+            http_proxy=env.get("http_proxy", "").strip() or None,
+            max_upstream_concurrency=parse("max_upstream_concurrency", int, 8),
+            model_routes=parse("model_routes", lambda v: json.dumps(json.loads(v)), None),
+            semantic_cache_dir=env.get("semantic_cache_dir", "").strip() or None,
+            semantic_cache_size=parse("semantic_cache_size", int, 10000),
+            semantic_cache_threshold=parse("semantic_cache_threshold", float, 0.9),
+            merge_window_ms=parse("merge_window_ms", int, 0),
+            prefilter_path=env.get("prefilter_path", "").strip() or None,
+            ledger_dir=env.get("ledger_dir", "").strip() or None,
+            user_tokens_per_day=parse("user_tokens_per_day", int, None),
+            chat_gpt_url=env.get("chat_gpt_url", "").strip() or "https://api.openai.com/v1/chat/completions",
+            traffic_capture_path=env.get("traffic_capture_path", "").strip() or None,
+            traffic_capture_plaintext=parse("traffic_capture_plaintext", parse_bool, False),
+            snapshot_path=env.get("snapshot_path", "").strip() or None,
+            retry_queue_path=env.get("retry_queue_path", "").strip() or None,
+            max_retry_workers=parse("max_retry_workers", int, 2),
+        )
+        if errors:
+            raise ConfigError("invalid server config:\n" + "\n".join(errors))
+        return config
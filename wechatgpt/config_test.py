@@ -0,0 +1,61 @@
+import unittest
+
+from .config import ConfigError, ServerConfig
+from .server import create_app
+
+
+def create_config() -> ServerConfig:
+    return ServerConfig.from_env(
+        {
+            "chat_gpt_token": "gpt-token",
+            "token": "admin-token",
+            "wechat_token": "wechat-token",
+            "admin_user_ids": "a, b",
+            "admin_email": "admin@example.com",
+        }
+    )
+
+
+class ServerConfigTest(unittest.TestCase):
+    def test_from_env(self):
+        config = create_config()
+        self.assertEqual(config.admin_user_ids, ["a", "b"])
+        self.assertEqual(config.white_list_user_ids, [])
+        self.assertIsNone(config.http_proxy)
+        self.assertEqual(config.max_upstream_concurrency, 8)
+        self.assertFalse(config.traffic_capture_plaintext)
+
+    def test_report_all_errors(self):
+        with self.assertRaises(ConfigError) as e:
+            ServerConfig.from_env({"chat_gpt_token": "gpt-token", "max_upstream_concurrency": "many", "model_routes": "[{", "traffic_capture_plaintext": "maybe"})
+        msg = e.exception.args[0]
+        for key in ["token", "wechat_token", "admin_user_ids", "admin_email", "max_upstream_concurrency", "model_routes", "traffic_capture_plaintext"]:
+            self.assertIn(key, msg)
+        self.assertNotIn("chat_gpt_token", msg)
+
+
+class CreateAppTest(unittest.TestCase):
+    def test_build_handlers_on_first_request(self):
+        app = create_app(create_config())
+        handlers = app.extensions["wechatgpt_handlers"]
+        self.assertIsNone(handlers.handlers)
+
+        response = app.test_client().get("/wechat?echostr=hello")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b"hello")
+        self.assertIsNotNone(handlers.handlers)
+
+        response = app.test_client().post("/wechat?signature=wrong", data="<xml></xml>")
+        self.assertEqual(response.status_code, 403)
+
+    def test_drain(self):
+        app = create_app(create_config())
+        self.assertEqual(app.test_client().post("/admin/drain?token=wrong").status_code, 403)
+        response = app.test_client().post("/admin/drain?token=admin-token&timeout=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"drained": True, "in_flight_chats": 0})
+        self.assertTrue(app.extensions["wechatgpt_handlers"].get()[0].draining)
+
+        self.assertEqual(app.test_client().post("/admin/undrain").status_code, 403)
+        self.assertEqual(app.test_client().post("/admin/undrain?token=admin-token").get_json(), {"draining": False})
+        self.assertFalse(app.extensions["wechatgpt_handlers"].get()[0].draining)
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import os
+from array import array
+from datetime import date, datetime
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .logger import get_logger
+
+EPOCH = date(1970, 1, 1)
+
+
+def day_number(at: datetime) -> int:
+    return (at.date() - EPOCH).days
+
+
+class TokenLedger:
+    """Records prompt/completion tokens, model and latency of every upstream call in 19 bytes per call.
+
+    Calls are kept in columnar arrays, users and models are interned as integer ids. With `path`, calls are appended
+    to a fixed size record file, and users/models to text files whose line numbers are the ids, all loaded on start.
+    Today's tokens per user are also counted on the fly, so quota checks don't need any aggregation.
+    """
+
+    DTYPE = np.dtype([("user", "<u4"), ("day", "<u2"), ("model", "u1"), ("prompt", "<u4"), ("completion", "<u4"), ("latency_ms", "<u4")])
+    COLUMNS = [("user", "I"), ("day", "H"), ("model", "B"), ("prompt", "I"), ("completion", "I"), ("latency_ms", "I")]
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        flush_every: int = 100,
+        current_date: Optional[Callable[[], datetime]] = None,
+    ) -> None:
+        self.path = path
+        self.flush_every = flush_every
+        default_current_date = lambda: datetime.now()
+        self.current_date = current_date or default_current_date
+        self.lock = Lock()
+        self.columns: Dict[str, array] = {name: array(code) for name, code in self.COLUMNS}
+        self.users: List[str] = []
+        self.user_ids: Dict[str, int] = {}
+        self.models: List[str] = []
+        self.model_ids: Dict[str, int] = {}
+        self.flushed_count, self.flushed_user_count, self.flushed_model_count = 0, 0, 0
+        self.today = day_number(self.current_date())
+        self.today_user_tokens: Dict[str, int] = {}
+        self.total_tokens = 0
+        if path:
+            self._load(path)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)  # type: ignore
+
+    def _load(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for file_name, names, ids in [("users.txt", self.users, self.user_ids), ("models.txt", self.models, self.model_ids)]:
+            if os.path.exists(self._file(file_name)):
+                with open(self._file(file_name), encoding="utf-8") as f:
+                    for line in f:
+                        ids[line.rstrip("\n")] = len(names)
+                        names.append(line.rstrip("\n"))
+        if os.path.exists(self._file("calls.bin")):
+            # drop a partially written record at the end, so that new records are appended aligned
+            size = os.path.getsize(self._file("calls.bin"))
+            os.truncate(self._file("calls.bin"), size - size % self.DTYPE.itemsize)
+            records = np.fromfile(self._file("calls.bin"), dtype=self.DTYPE)
+            records = records[(records["user"] < len(self.users)) & (records["model"] < len(self.models))]
+            for name, _ in self.COLUMNS:
+                self.columns[name].frombytes(np.ascontiguousarray(records[name]).tobytes())
+            self.total_tokens = int(records["prompt"].sum(dtype=np.int64) + records["completion"].sum(dtype=np.int64))
+            today_records = records[records["day"] == self.today]
+            tokens = today_records["prompt"].astype(np.int64) + today_records["completion"]
+            user_tokens = np.bincount(today_records["user"], weights=tokens, minlength=len(self.users))
+            self.today_user_tokens = {self.users[i]: int(t) for i, t in enumerate(user_tokens) if t}
+        self.flushed_count, self.flushed_user_count, self.flushed_model_count = len(self), len(self.users), len(self.models)
+        get_logger().info(f"loaded token ledger with {len(self)} calls from {path}")
+
+    def __len__(self) -> int:
+        return len(self.columns["user"])
+
+    def _intern(self, name: str, names: List[str], ids: Dict[str, int]) -> int:
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
+
+    def _rollover_today(self, today: int):
+        if today != self.today:
+            self.today = today
+            self.today_user_tokens = {}
+
+    def record(self, user: str, model: str, prompt_tokens: int, completion_tokens: int, latency_seconds: float):
+        with self.lock:
+            today = day_number(self.current_date())
+            self._rollover_today(today)
+            values = {
+                "user": self._intern(user, self.users, self.user_ids),
+                "day": today,
+                "model": self._intern(model, self.models, self.model_ids),
+                "prompt": prompt_tokens,
+                "completion": completion_tokens,
+                "latency_ms": int(latency_seconds * 1000),
+            }
+            for name, column in self.columns.items():
+                column.append(values[name])
+            tokens = prompt_tokens + completion_tokens
+            self.today_user_tokens[user] = self.today_user_tokens.get(user, 0) + tokens
+            self.total_tokens += tokens
+            if self.path and len(self) - self.flushed_count >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        if not self.path:
+            return
+        # names go first, so that a crash never leaves records pointing to unknown names
+        for file_name, names, flushed in [("users.txt", self.users, self.flushed_user_count), ("models.txt", self.models, self.flushed_model_count)]:
+            if len(names) > flushed:
+                with open(self._file(file_name), "a", encoding="utf-8") as f:
+                    f.write("".join(f"{n}\n" for n in names[flushed:]))
+        with open(self._file("calls.bin"), "ab") as f:
+            f.write(self.records(self.flushed_count).tobytes())
+        self.flushed_count, self.flushed_user_count, self.flushed_model_count = len(self), len(self.users), len(self.models)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def records(self, start: int = 0) -> np.ndarray:
+        records = np.empty(len(self) - start, dtype=self.DTYPE)
+        for name, _ in self.COLUMNS:
+            records[name] = np.frombuffer(self.columns[name], dtype=self.DTYPE[name])[start:]
+        return records
+
+    def user_tokens_today(self, user: str) -> int:
+        with self.lock:
+            self._rollover_today(day_number(self.current_date()))
+            return self.today_user_tokens.get(user, 0)
+
+    def today_tokens(self) -> int:
+        with self.lock:
+            self._rollover_today(day_number(self.current_date()))
+            return sum(self.today_user_tokens.values())
+
+    def aggregate(self, by: str, limit: Optional[int] = None) -> List[Tuple[str, int, int, int]]:
+        """Returns (key, calls, prompt tokens, completion tokens) grouped by `user`, `day` or `model`, most tokens first."""
+        if by not in ("user", "day", "model"):
+            raise ValueError(f"unknown aggregation: {by}")
+        # copy the columns, arrays can't grow while numpy views on them are alive
+        with self.lock:
+            keys = np.frombuffer(self.columns[by], dtype=self.DTYPE[by]).astype(np.int64)
+            prompt = np.frombuffer(self.columns["prompt"], dtype=np.uint32).copy()
+            completion = np.frombuffer(self.columns["completion"], dtype=np.uint32).copy()
+            users, models = list(self.users), list(self.models)
+        if len(keys) == 0:
+            return []
+        offset = int(keys.min())
+        calls = np.bincount(keys - offset)
+        prompt_sums = np.bincount(keys - offset, weights=prompt)
+        completion_sums = np.bincount(keys - offset, weights=completion)
+        order = np.argsort(-(prompt_sums + completion_sums), kind="stable")
+        order = order[calls[order] > 0][:limit]
+
+        def key_name(i: int) -> str:
+            if by == "user":
+                return users[i + offset]
+            if by == "model":
+                return models[i + offset]
+            return (date.fromordinal(EPOCH.toordinal() + i + offset)).isoformat()
+
+        return [(key_name(int(i)), int(calls[i]), int(prompt_sums[i]), int(completion_sums[i])) for i in order]
+
+    def stat(self) -> dict:
+        return {"total_call_count": len(self), "total_tokens": self.total_tokens, "today_tokens": self.today_tokens()}
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from .ledger import TokenLedger
+from .usage_policy import UsagePolicy
+
+
+class TokenLedgerTest(unittest.TestCase):
+    def test_record_and_aggregate(self):
+        return_date = datetime(2023, 1, 1, 10, 0, 0)
+
+        def current_date():
+            return return_date
+
+        ledger = TokenLedger(current_date=current_date)
+        ledger.record("a", "gpt-3.5-turbo", 100, 50, 1.5)
+        ledger.record("b", "gpt-4", 10, 5, 0.5)
+        return_date = datetime(2023, 1, 2, 10, 0, 0)
+        ledger.record("a", "gpt-3.5-turbo", 20, 10, 1.0)
+
+        self.assertEqual(ledger.aggregate("user"), [("a", 2, 120, 60), ("b", 1, 10, 5)])
+        self.assertEqual(ledger.aggregate("model", limit=1), [("gpt-3.5-turbo", 2, 120, 60)])
+        self.assertEqual(ledger.aggregate("day"), [("2023-01-01", 2, 110, 55), ("2023-01-02", 1, 20, 10)])
+        self.assertEqual(ledger.user_tokens_today("a"), 30)
+        self.assertEqual(ledger.user_tokens_today("b"), 0)
+        self.assertEqual(ledger.stat(), {"total_call_count": 3, "total_tokens": 195, "today_tokens": 30})
+        self.assertRaises(ValueError, lambda: ledger.aggregate("hour"))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as path:
+            ledger = TokenLedger(path, flush_every=2)
+            ledger.record("a", "gpt-3.5-turbo", 100, 50, 1.5)
+            ledger.record("b", "gpt-4", 10, 5, 0.5)
+            ledger.record("a", "gpt-3.5-turbo", 20, 10, 1.0)
+            self.assertEqual(len(TokenLedger(path)), 2)
+            ledger.flush()
+            self.assertEqual(os.path.getsize(os.path.join(path, "calls.bin")), 3 * 19)
+
+            # a partially written record is dropped
+            with open(os.path.join(path, "calls.bin"), "ab") as f:
+                f.write(b"\x01\x02")
+            reloaded = TokenLedger(path)
+            self.assertEqual(reloaded.aggregate("user"), ledger.aggregate("user"))
+            self.assertEqual(reloaded.user_tokens_today("a"), 180)
+            reloaded.record("c", "gpt-4", 1, 1, 0.1)
+            reloaded.flush()
+            self.assertEqual(len(TokenLedger(path)), 4)
+
+    def test_memory_per_call(self):
+        ledger = TokenLedger()
+        for i in range(100000):
+            ledger.record(f"user-{i % 1000}", "gpt-3.5-turbo", 100, 50, 1.0)
+        column_bytes = sum(c.buffer_info()[1] * c.itemsize for c in ledger.columns.values())
+        self.assertEqual(column_bytes / len(ledger), 19)
+
+    def test_token_quota(self):
+        ledger = TokenLedger()
+        up = UsagePolicy(["admin"], user_chat_count_per_day={"vip": 100}, ledger=ledger, default_user_tokens_per_day=100)
+        for user in ["a", "vip", "admin"]:
+            up.on_chat(user)
+            ledger.record(user, "gpt-3.5-turbo", 80, 30, 1.0)
+        self.assertTrue(up.reached_limit("a"))
+        self.assertFalse(up.reached_limit("vip"))
+        self.assertFalse(up.reached_limit("admin"))
+        self.assertEqual(up.get_stat({})["today_tokens"], 330)
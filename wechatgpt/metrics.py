@@ -0,0 +1,32 @@
+from threading import Lock
+from typing import Dict
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+
+    def incr(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def get(self, name: str) -> float:
+        with self.lock:
+            return self.counters.get(name, self.gauges.get(name, 0))
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            return dict(sorted({**self.counters, **self.gauges}.items()))
+
+
+metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    return metrics
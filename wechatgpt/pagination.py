@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import re
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from .metrics import get_metrics
+
+# a sentence ends after these, together with closing quotes/brackets and trailing spaces
+SENTENCE_END = re.compile(r"(?<=[。！？；!?;\n])[”’」』）)\"']*\s*|(?<=[.])[\"')]*\s+")
+
+
+def utf8_len(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def _split_long_sentence(sentence: str, max_bytes: int) -> List[str]:
+    pieces: List[str] = []
+    piece, size = [], 0
+    for c in sentence:
+        c_size = utf8_len(c)
+        if size + c_size > max_bytes:
+            pieces.append("".join(piece))
+            piece, size = [], 0
+        piece.append(c)
+        size += c_size
+    if piece:
+        pieces.append("".join(piece))
+    return pieces
+
+
+def split_pages(text: str, max_bytes: int) -> List[str]:
+    """Splits `text` into pages of at most `max_bytes` utf-8 bytes, at sentence ends where possible."""
+    if utf8_len(text) <= max_bytes:
+        return [text]
+    pages: List[str] = []
+    page, size = "", 0
+    start = 0
+    sentences = []
+    for m in SENTENCE_END.finditer(text):
+        if m.end() > start:
+            sentences.append(text[start : m.end()])
+            start = m.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    for sentence in sentences:
+        sentence_size = utf8_len(sentence)
+        if size + sentence_size <= max_bytes:
+            page, size = page + sentence, size + sentence_size
+            continue
+        if page:
+            pages.append(page)
+        page, size = "", 0
+        if sentence_size <= max_bytes:
+            page, size = sentence, sentence_size
+            continue
+        *full_pieces, page = _split_long_sentence(sentence, max_bytes)
+        pages.extend(full_pieces)
+        size = utf8_len(page)
+    if page:
+        pages.append(page)
+    return [p.strip() for p in pages if p.strip()]
+
+
+class AnswerPager:
+    """Splits long answers once into pages that fit a wechat reply, and keeps the unread pages of recent users.
+
+    Every page but the last ends with a hint to reply one of `more_keywords` for the next page, which is served from
+    here without asking the bot again.
+    """
+
+    def __init__(self, max_page_bytes: int = 2000, max_users: int = 10000) -> None:
+        # wechat rejects passive text replies longer than 2048 bytes
+        self.max_page_bytes = max_page_bytes
+        self.max_users = max_users
+        self.more_keywords = ("更多", "more")
+        self.more_hint = "\n\n（第{page}/{total}页，回复“更多”查看下一页）"
+        self.lock = Lock()
+        # user -> (pages, index of the page to serve next)
+        self.user_pages: OrderedDict[str, Tuple[List[str], int]] = OrderedDict()
+
+    def _page(self, pages: List[str], index: int) -> str:
+        if index == len(pages) - 1:
+            return pages[index]
+        return pages[index] + self.more_hint.format(page=index + 1, total=len(pages))
+
+    def paginate(self, user: str, answer: str) -> str:
+        """Returns the first page of `answer`, keeping the rest for `next_page`."""
+        hint_bytes = utf8_len(self.more_hint.format(page=999, total=999))
+        pages = split_pages(answer, self.max_page_bytes - hint_bytes) if utf8_len(answer) > self.max_page_bytes else [answer]
+        with self.lock:
+            self.user_pages.pop(user, None)
+            if len(pages) > 1:
+                get_metrics().incr("pagination.paged_answers")
+                self.user_pages[user] = (pages, 1)
+                while len(self.user_pages) > self.max_users:
+                    self.user_pages.popitem(last=False)
+        return self._page(pages, 0)
+
+    def is_more_request(self, text: str) -> bool:
+        return text.strip().lower() in self.more_keywords
+
+    def next_page(self, user: str) -> Optional[str]:
+        """Returns the next unread page of the user's last answer, None if there is none."""
+        with self.lock:
+            if user not in self.user_pages:
+                return None
+            pages, index = self.user_pages[user]
+            if index + 1 < len(pages):
+                self.user_pages[user] = (pages, index + 1)
+            else:
+                del self.user_pages[user]
+        # each of these would have been another upstream call to get the rest of the answer
+        get_metrics().incr("pagination.served_pages")
+        return self._page(pages, index)
+
+    def to_snapshot(self) -> dict:
+        with self.lock:
+            return {user: [pages, index] for user, (pages, index) in self.user_pages.items()}
+
+    def load_snapshot(self, data: dict):
+        with self.lock:
+            self.user_pages = OrderedDict((user, (pages, index)) for user, (pages, index) in data.items())
@@ -0,0 +1,41 @@
+import re
+import unittest
+
+from .pagination import AnswerPager, split_pages, utf8_len
+
+
+class SplitPagesTest(unittest.TestCase):
+    def test_split_at_sentence_ends(self):
+        text = "第一句话。第二句话！Third sentence. 第四句话？"
+        self.assertEqual(split_pages(text, 100), [text])
+        self.assertEqual(split_pages(text, 30), ["第一句话。第二句话！", "Third sentence.", "第四句话？"])
+
+    def test_split_long_sentence(self):
+        pages = split_pages("长" * 100, 60)
+        self.assertEqual([utf8_len(p) for p in pages], [60, 60, 60, 60, 60])
+        self.assertEqual("".join(pages), "长" * 100)
+
+
+class AnswerPagerTest(unittest.TestCase):
+    def test_pages(self):
+        pager = AnswerPager(max_page_bytes=200)
+        self.assertEqual(pager.paginate("a", "short answer"), "short answer")
+        self.assertIsNone(pager.next_page("a"))
+
+        first = pager.paginate("a", "这是一个句子。" * 30)
+        self.assertTrue(first.endswith("回复“更多”查看下一页）"))
+        self.assertTrue(pager.is_more_request(" More "))
+        pages = [first]
+        while True:
+            page = pager.next_page("a")
+            if page is None:
+                break
+            pages.append(page)
+        self.assertTrue(all(utf8_len(p) <= 200 for p in pages))
+        # the last page has no hint
+        for i, page in enumerate(pages[:-1], 1):
+            self.assertEqual(re.search(r"第(\d+)/(\d+)页", page).groups(), (str(i), str(len(pages))))  # type: ignore
+        # a new answer drops the unread pages of the previous one
+        pager.paginate("a", "这是一个句子。" * 30)
+        pager.paginate("a", "short answer")
+        self.assertIsNone(pager.next_page("a"))
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import time
+from collections import deque
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .logger import get_logger
+from .metrics import get_metrics
+
+
+class KeywordAutomaton:
+    """An Aho-Corasick automaton, finds any of the keywords in a text in one pass regardless of the keyword count."""
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.transitions: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Optional[str]] = [None]
+        for keyword in keywords:
+            if keyword:
+                self._add(keyword.lower())
+        self._build_fail_links()
+
+    def _add(self, keyword: str):
+        node = 0
+        for ch in keyword:
+            if ch not in self.transitions[node]:
+                self.transitions.append({})
+                self.fail.append(0)
+                self.output.append(None)
+                self.transitions[node][ch] = len(self.transitions) - 1
+            node = self.transitions[node][ch]
+        self.output[node] = keyword
+
+    def _build_fail_links(self):
+        queue = deque(self.transitions[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.transitions[node].items():
+                fail = self.fail[node]
+                while fail and ch not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.transitions[fail].get(ch, 0)
+                # a keyword ending at the fail node also ends here
+                self.output[child] = self.output[child] or self.output[self.fail[child]]
+                queue.append(child)
+
+    def search(self, text: str) -> Optional[str]:
+        """Returns the first keyword found in the text, None if there is none."""
+        node = 0
+        for ch in text.lower():
+            while node and ch not in self.transitions[node]:
+                node = self.fail[node]
+            node = self.transitions[node].get(ch, 0)
+            if self.output[node]:
+                return self.output[node]
+        return None
+
+
+class PrefilterRules:
+    # messages of only punctuation, emoji or wechat emoji codes like "[微笑]" and "/::)"
+    TRIVIAL_MSG = re.compile(r"^(?:[\W_]|\[[^\[\]\s]{1,4}\]|/:\S{1,6})+$")
+
+    def __init__(
+        self,
+        blocked_words: Optional[List[str]] = None,
+        blocked_reply: str = "抱歉，这个问题我无法回答。",
+        canned_replies: Optional[Dict[str, str]] = None,
+        trivial_msg_reply: Optional[str] = None,
+    ) -> None:
+        self.blocked_words = KeywordAutomaton(blocked_words or [])
+        self.blocked_reply = blocked_reply
+        self.canned_replies = {self.normalize(k): v for k, v in (canned_replies or {}).items()}
+        self.trivial_msg_reply = trivial_msg_reply
+
+    @staticmethod
+    def from_file(path: str) -> PrefilterRules:
+        with open(path, encoding="utf-8") as f:
+            return PrefilterRules(**json.load(f))
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r"[\s!?.,~！？。，～]+$", "", text.strip().lower())
+
+
+class MessagePrefilter:
+    """Replies to blocked and trivial messages locally, so that they never cost an upstream call.
+
+    Rules are loaded from a json file with `blocked_words`, `blocked_reply`, `canned_replies` (exact message to reply)
+    and `trivial_msg_reply` (for emoji-only messages), and reloaded when the file changes.
+    """
+
+    def __init__(self, path: str, reload_interval_seconds: float = 10) -> None:
+        self.path = path
+        self.reload_interval_seconds = reload_interval_seconds
+        self.lock = Lock()
+        self.rules = PrefilterRules()
+        self.rules_mtime: Optional[float] = None
+        self.last_check_at = 0.0
+        self._reload_if_changed()
+
+    def _reload_if_changed(self):
+        self.last_check_at = time.time()
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.rules_mtime:
+                return
+            rules = PrefilterRules.from_file(self.path)
+        except Exception:
+            get_logger().error(f"unable to load prefilter rules from {self.path}, keep the current ones: ", exc_info=True)
+            return
+        self.rules, self.rules_mtime = rules, mtime
+        get_logger().info(f"loaded prefilter rules from {self.path}")
+
+    def _match(self, text: str) -> Tuple[Optional[str], Optional[str]]:
+        if time.time() - self.last_check_at >= self.reload_interval_seconds and self.lock.acquire(blocking=False):
+            try:
+                self._reload_if_changed()
+            finally:
+                self.lock.release()
+        rules = self.rules
+        reply, kind = None, None
+        if rules.blocked_words.search(text):
+            reply, kind = rules.blocked_reply, "blocked"
+        if reply is None:
+            reply, kind = rules.canned_replies.get(PrefilterRules.normalize(text)), "canned"
+        if reply is None and rules.trivial_msg_reply and PrefilterRules.TRIVIAL_MSG.match(text.strip()):
+            reply, kind = rules.trivial_msg_reply, "trivial"
+        return reply, kind
+
+    def matches(self, text: str) -> bool:
+        """Whether the message would be replied locally, without counting it."""
+        return self._match(text)[0] is not None
+
+    def filter(self, text: str) -> Optional[str]:
+        """Returns the reply for the message if it should not go to the bot."""
+        reply, kind = self._match(text)
+        if reply is not None:
+            get_metrics().incr(f"prefilter.{kind}")
+            get_metrics().incr("prefilter.saved_upstream_calls")
+        return reply
@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from .metrics import get_metrics
+from .prefilter import KeywordAutomaton, MessagePrefilter
+
+
+class KeywordAutomatonTest(unittest.TestCase):
+    def test_search(self):
+        automaton = KeywordAutomaton(["he", "she", "his", "hers", "敏感词"])
+        self.assertEqual(automaton.search("ushers"), "she")
+        self.assertEqual(automaton.search("this"), "his")
+        self.assertEqual(automaton.search("一个敏感词的例子"), "敏感词")
+        self.assertEqual(automaton.search("HE"), "he")
+        self.assertIsNone(automaton.search("敏感 词"))
+        self.assertIsNone(KeywordAutomaton([]).search("anything"))
+
+    def test_search_through_fail_links(self):
+        automaton = KeywordAutomaton(["abcd", "bce"])
+        self.assertEqual(automaton.search("xabce"), "bce")
+
+
+class MessagePrefilterTest(unittest.TestCase):
+    def write_rules(self, path: str, rules: dict):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(rules, f, ensure_ascii=False)
+
+    def test_filter_and_reload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "prefilter.json")
+            self.write_rules(
+                path,
+                {
+                    "blocked_words": ["违禁"],
+                    "blocked_reply": "无法回答",
+                    "canned_replies": {"你好": "你好！有什么可以帮您？"},
+                    "trivial_msg_reply": "[微笑]",
+                },
+            )
+            prefilter = MessagePrefilter(path, reload_interval_seconds=0)
+            saved_count = get_metrics().get("prefilter.saved_upstream_calls")
+            self.assertEqual(prefilter.filter("这是违禁内容吗"), "无法回答")
+            self.assertEqual(prefilter.filter(" 你好！"), "你好！有什么可以帮您？")
+            self.assertEqual(prefilter.filter("😊😊"), "[微笑]")
+            self.assertEqual(prefilter.filter("[微笑]/::)"), "[微笑]")
+            self.assertIsNone(prefilter.filter("你好，请问怎么学英语？"))
+            self.assertIsNone(prefilter.filter("1"))
+            self.assertEqual(get_metrics().get("prefilter.saved_upstream_calls"), saved_count + 4)
+
+            self.write_rules(path, {"blocked_words": ["英语"]})
+            os.utime(path, (time.time() + 1, time.time() + 1))
+            self.assertEqual(prefilter.filter("你好，请问怎么学英语？"), "抱歉，这个问题我无法回答。")
+            self.assertIsNone(prefilter.filter("你好"))
+
+            with open(path, "w") as f:
+                f.write("{broken")
+            os.utime(path, (time.time() + 2, time.time() + 2))
+            self.assertIsNotNone(prefilter.filter("英语"))
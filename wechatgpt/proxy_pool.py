@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import random
+import time
+from threading import Lock, Thread
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from .logger import get_logger
+from .metrics import get_metrics
+
+
+def redact_proxy_url(url: str) -> str:
+    """Returns host:port of a proxy url, which may carry user:password@, for logs and stats."""
+    try:
+        parts = urlsplit(url if "//" in url else f"//{url}")
+        return f"{parts.hostname}:{parts.port}" if parts.port else str(parts.hostname)
+    except ValueError:
+        return "<invalid proxy url>"
+
+
+class ProxyState:
+    def __init__(self, url: str, index: int) -> None:
+        self.url = url
+        # metrics are keyed by the position in the pool, logs show the redacted url
+        self.index = index
+        self.name = redact_proxy_url(url)
+        self.ewma_latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.healthy = True
+
+    def __str__(self) -> str:
+        return f"{{proxy={self.index}/{self.name}, ewma_latency={self.ewma_latency}, consecutive_failures={self.consecutive_failures}, healthy={self.healthy}}}"
+
+
+class ProxyPool:
+    """A pool of upstream proxies with background health probes.
+
+    Requests pick a healthy proxy by power-of-two-choices on the EWMA of the probe latency. The latency is only taken
+    from probes, because the time of an upstream call is dominated by the answer generation. A proxy is ejected after
+    `max_failures` consecutive failed probes or requests, and re-admitted by the next successful probe.
+    """
+
+    def __init__(
+        self,
+        proxies: List[str],
+        probe_url: str = "https://api.openai.com/v1/models",
+        probe_interval_seconds: float = 30,
+        probe_timeout_seconds: float = 5,
+        max_failures: int = 3,
+        ewma_alpha: float = 0.3,
+    ) -> None:
+        assert proxies, "at least one proxy is required"
+        self.proxies = [ProxyState(p, i) for i, p in enumerate(proxies)]
+        self.probe_url = probe_url
+        self.probe_interval_seconds = probe_interval_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+        self.max_failures = max_failures
+        self.ewma_alpha = ewma_alpha
+        self.lock = Lock()
+        self.probe_thread: Optional[Thread] = None
+
+    def _state(self, proxy: str) -> Optional[ProxyState]:
+        return next((p for p in self.proxies if p.url == proxy), None)
+
+    def _latency(self, state: ProxyState) -> float:
+        # not probed yet, prefer it so that it gets measured
+        return state.ewma_latency if state.ewma_latency is not None else 0.0
+
+    def select(self) -> str:
+        with self.lock:
+            candidates = [p for p in self.proxies if p.healthy]
+            if not candidates:
+                # all ejected, the least failing one is still better than no answer at all
+                return min(self.proxies, key=lambda p: p.consecutive_failures).url
+            if len(candidates) == 1:
+                return candidates[0].url
+            a, b = random.sample(candidates, 2)
+            return (a if self._latency(a) <= self._latency(b) else b).url
+
+    def report_success(self, proxy: str, latency_seconds: Optional[float] = None):
+        with self.lock:
+            state = self._state(proxy)
+            if state is None:
+                return
+            if latency_seconds is not None:
+                if state.ewma_latency is None:
+                    state.ewma_latency = latency_seconds
+                else:
+                    state.ewma_latency += self.ewma_alpha * (latency_seconds - state.ewma_latency)
+            state.consecutive_failures = 0
+            if not state.healthy:
+                get_logger().info(f"proxy re-admitted: {state}")
+                state.healthy = True
+            get_metrics().set(f"proxy.{state.index}.ewma_latency", round(state.ewma_latency or 0, 4))
+
+    def report_failure(self, proxy: str):
+        with self.lock:
+            state = self._state(proxy)
+            if state is None:
+                return
+            state.consecutive_failures += 1
+            get_metrics().incr(f"proxy.{state.index}.failures")
+            if state.healthy and state.consecutive_failures >= self.max_failures:
+                get_logger().warning(f"proxy ejected: {state}")
+                state.healthy = False
+
+    def probe(self, proxy: str):
+        started_at = time.time()
+        try:
+            r = requests.get(self.probe_url, proxies={"http": proxy, "https": proxy}, timeout=self.probe_timeout_seconds)
+            # any answer from the upstream is fine (e.g. 401 without a token), 5xx come from a broken proxy or upstream
+            ok = r.status_code < 500
+        except requests.RequestException as e:
+            get_logger().info(f"failed to probe proxy {redact_proxy_url(proxy)}: {type(e).__name__}")
+            ok = False
+        if ok:
+            self.report_success(proxy, time.time() - started_at)
+        else:
+            self.report_failure(proxy)
+
+    def probe_all(self):
+        for state in self.proxies:
+            self.probe(state.url)
+
+    def _probe_forever(self):
+        while True:
+            try:
+                self.probe_all()
+            except Exception:
+                get_logger().error("failed to probe proxies: ", exc_info=True)
+            time.sleep(self.probe_interval_seconds)
+
+    def start(self):
+        if self.probe_thread is None:
+            self.probe_thread = Thread(target=self._probe_forever, daemon=True)
+            self.probe_thread.start()
+
+    def stat(self) -> List[str]:
+        with self.lock:
+            return [str(p) for p in self.proxies]
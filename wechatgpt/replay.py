@@ -0,0 +1,183 @@
+"""Replays captured traffic (see `traffic_capture_path`) against the message handler and a local fake completions endpoint.
+
+Run with `python -m wechatgpt.replay capture.jsonl [--speed N]`. Messages are sent at their captured pace divided by
+`speed`, and every user's upstream calls are answered in the captured order with the captured latency (also divided by
+`speed`) and status. The handler is built from the environment like the server (required values may be left out), so
+scheduler, cache, merge window and prefilter settings can be compared offline on real bursts and wechat retries.
+Files the server would write (ledger, semantic cache, retry queue) are kept in a temporary folder instead, and neither
+traffic capture nor the state snapshot is used. Waits inside the handler, e.g. for wechat retries, are not sped up.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import atexit
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Mapping, Optional
+
+from .config import ServerConfig
+from .metrics import get_metrics
+from .server import build_handlers
+from .traffic import hash_user_id, read_events
+
+REPLAY_ENV = {
+    "chat_gpt_token": "replay-token",
+    "token": "replay-admin-token",
+    "wechat_token": "replay-wechat-token",
+    "admin_user_ids": "replay-admin",
+    "admin_email": "replay@example.com",
+}
+
+
+class FakeCompletions:
+    """A local completions endpoint answering every user's calls with the captured outcomes, in order."""
+
+    def __init__(self, upstream_events: List[dict], speed: float = 1.0, default_latency_seconds: float = 1.0) -> None:
+        self.speed = speed
+        self.default_latency_seconds = default_latency_seconds
+        self.lock = threading.Lock()
+        # the replayed user names are the captured hashes, which the bot hashes once more
+        self.outcomes: Dict[str, Deque[dict]] = {}
+        for event in upstream_events:
+            self.outcomes.setdefault(hash_user_id(event["user"]), deque()).append(event)
+        self.call_count = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                outcome = fake.next_outcome(data.get("user", ""))
+                time.sleep(outcome.get("latency", fake.default_latency_seconds) / fake.speed)
+                status = outcome.get("status", 200)
+                if status is None:
+                    # the captured call failed without a response
+                    self.close_connection = True
+                    return
+                if status == 200:
+                    prompt_tokens = sum(len(m["content"]) for m in data["messages"])
+                    completion_tokens = outcome.get("completion_tokens", 0)
+                    body = {
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                        "choices": [{"message": {"content": "replayed answer " + "x" * completion_tokens}}],
+                    }
+                else:
+                    body = {"error": {"code": "replayed_error", "message": f"replayed status {status}"}}
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def next_outcome(self, hashed_user: str) -> dict:
+        with self.lock:
+            self.call_count += 1
+            outcomes = self.outcomes.get(hashed_user)
+            return outcomes.popleft() if outcomes else {}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _request_xml(user: str, text: str) -> str:
+    return (
+        f"<xml><ToUserName><![CDATA[replay-account]]></ToUserName><FromUserName><![CDATA[{user}]]></FromUserName>"
+        f"<CreateTime>{int(time.time())}</CreateTime><MsgType><![CDATA[text]]></MsgType>"
+        f"<Content><![CDATA[{text}]]></Content></xml>"
+    )
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def replay(path: str, speed: float = 1.0, environ: Optional[Mapping[str, str]] = None) -> dict:
+    """Replays the capture at `path` and returns the latencies (seconds) and the replies of the handled messages."""
+    from .wechat_handler import Request
+
+    events = list(read_events(path))
+    requests = [e for e in events if e["kind"] == "request" and e.get("user") and e.get("text") is not None]
+    fake = FakeCompletions([e for e in events if e["kind"] == "upstream"], speed)
+    env = {**REPLAY_ENV, **(os.environ if environ is None else environ)}
+    config = ServerConfig.from_env(env)
+    config.chat_gpt_url, config.http_proxy, config.http_proxies = fake.url, None, []
+    # never touch the files of a live server configured by the same environment
+    folder = tempfile.mkdtemp(prefix="wechatgpt-replay-")
+    # registered first, so that it runs after the handlers flushed their files at exit
+    atexit.register(shutil.rmtree, folder, ignore_errors=True)
+    config.ledger_dir = os.path.join(folder, "ledger") if config.ledger_dir else None
+    config.semantic_cache_dir = os.path.join(folder, "semantic-cache") if config.semantic_cache_dir else None
+    config.retry_queue_path = os.path.join(folder, "retry.db") if config.retry_queue_path else None
+    config.traffic_capture_path, config.snapshot_path = None, None
+    handler, _ = build_handlers(config)
+
+    latencies: List[float] = []
+    replies: Counter = Counter()
+    lock = threading.Lock()
+
+    def send(event: dict):
+        started_at = time.perf_counter()
+        response = handler.handle(Request("POST", "/wechat", _request_xml(event["user"], event["text"])))
+        latency = time.perf_counter() - started_at
+        text = response.body.split("<Content><![CDATA[", 1)[-1].split("]]>", 1)[0] if response.body else ""
+        with lock:
+            latencies.append(latency)
+            replies[text if not text.startswith("replayed answer") else "replayed answer"] += 1
+
+    threads = []
+    started_at = time.perf_counter()
+    first_t = requests[0]["t"] if requests else 0
+    for event in requests:
+        delay = (event["t"] - first_t) / speed - (time.perf_counter() - started_at)
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=send, args=(event,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    fake.close()
+    return {"latencies": latencies, "replies": replies, "upstream_calls": fake.call_count, "elapsed": time.perf_counter() - started_at}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay captured wechat traffic against a fake completions endpoint")
+    parser.add_argument("path", help="a capture written with traffic_capture_path")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay N times faster than captured")
+    args = parser.parse_args()
+    result = replay(args.path, args.speed)
+    latencies = result["latencies"]
+    print(f"replayed {len(latencies)} messages in {result['elapsed']:.2f}s, {result['upstream_calls']} upstream calls")
+    if latencies:
+        print(
+            f"latency: p50={statistics.median(latencies) * 1000:.1f}ms p95={_percentile(latencies, 0.95) * 1000:.1f}ms "
+            f"max={max(latencies) * 1000:.1f}ms"
+        )
+    print("replies:")
+    for reply, count in result["replies"].most_common(10):
+        print(f"{count:>8} {reply[:40]!r}")
+    print(json.dumps(get_metrics().snapshot(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import threading
+import time
+from typing import Optional
+
+# uWSGI serves one request per thread, so thread local state is request scoped.
+_local = threading.local()
+
+
+def start_request(started_at: Optional[float] = None):
+    _local.started_at = started_at or time.time()
+
+
+def request_elapsed_seconds() -> float:
+    started_at = getattr(_local, "started_at", None)
+    return time.time() - started_at if started_at else 0.0
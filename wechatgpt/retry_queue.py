@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Set, Tuple
+
+from .logger import get_logger
+from .metrics import get_metrics
+
+# (user, account, question) -> whether the question got an answer, None if it was not tried now and should be later
+RetryWorker = Callable[[str, str, str], Optional[bool]]
+
+
+class RetryQueue:
+    """A durable queue of questions whose answer failed, retried in the background with exponential backoff.
+
+    Jobs are kept in a SQLite file, so they survive restarts, and a user has at most one queued job: a newer failed
+    question replaces the older one. At most `max_workers` jobs are retried at a time, the n-th retry of a job waits
+    `base_delay_seconds * 2 ** n` (with jitter, up to `max_delay_seconds`), and a job is dropped after `max_attempts`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_workers: int = 2,
+        max_attempts: int = 5,
+        base_delay_seconds: float = 5,
+        max_delay_seconds: float = 300,
+        poll_interval_seconds: float = 1,
+    ) -> None:
+        self.path = path
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # a commit survives a crash of the process, only a power loss may lose the last ones
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                user TEXT PRIMARY KEY,
+                account TEXT NOT NULL,
+                question TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run_at REAL NOT NULL,
+                running INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_next_run_at ON jobs (running, next_run_at)")
+        # jobs running when the last process stopped are retried again
+        self.conn.execute("UPDATE jobs SET running = 0")
+        # checked on every "1" and answered question, without touching the file
+        self.queued_users: Set[str] = {row[0] for row in self.conn.execute("SELECT user FROM jobs")}
+        self.threads: List[threading.Thread] = []
+
+    def _delay(self, attempts: int) -> float:
+        delay = min(self.max_delay_seconds, self.base_delay_seconds * 2**attempts)
+        return delay * random.uniform(0.8, 1.2)
+
+    def enqueue(self, user: str, account: str, question: str):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (user, account, question, attempts, next_run_at, running) VALUES (?, ?, ?, 0, ?, 0)",
+                (user, account, question, time.time() + self._delay(0)),
+            )
+            self.queued_users.add(user)
+        get_metrics().incr("retry_queue.queued")
+        get_logger().info(f"queued question of user {user} for retry: {question}")
+        self._update_depth()
+
+    def has_job(self, user: str) -> bool:
+        return user in self.queued_users
+
+    def cancel(self, user: str):
+        """Drops the queued job of the user, e.g. the user asked again and got an answer."""
+        if user not in self.queued_users:
+            return
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE user = ?", (user,))
+            self.queued_users.discard(user)
+        self._update_depth()
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def _update_depth(self):
+        get_metrics().set("retry_queue.depth", self.depth())
+
+    def _claim(self) -> Optional[Tuple[str, str, str, int]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT user, account, question, attempts FROM jobs WHERE running = 0 AND next_run_at <= ? ORDER BY next_run_at LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE jobs SET running = 1 WHERE user = ?", (row[0],))
+            return row
+
+    def _finish(self, user: str, question: str, attempts: int, answered: bool):
+        with self.lock:
+            # the job may have been replaced by a newer question while running, which is kept
+            if answered or attempts >= self.max_attempts:
+                if self.conn.execute("DELETE FROM jobs WHERE user = ? AND question = ? AND running = 1", (user, question)).rowcount:
+                    self.queued_users.discard(user)
+            else:
+                self.conn.execute(
+                    "UPDATE jobs SET attempts = ?, next_run_at = ?, running = 0 WHERE user = ? AND question = ? AND running = 1",
+                    (attempts, time.time() + self._delay(attempts), user, question),
+                )
+        if answered:
+            get_metrics().incr("retry_queue.succeeded")
+        elif attempts >= self.max_attempts:
+            get_metrics().incr("retry_queue.gave_up")
+            get_logger().info(f"gave up retrying question of user {user} after {attempts} attempts: {question}")
+        else:
+            get_metrics().incr("retry_queue.failed_attempts")
+        self._update_depth()
+
+    def _release(self, user: str, question: str):
+        """Puts a claimed job back without counting an attempt, it is tried again after the base delay."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET next_run_at = ?, running = 0 WHERE user = ? AND question = ? AND running = 1",
+                (time.time() + self._delay(0), user, question),
+            )
+
+    def run_once(self, worker: RetryWorker) -> bool:
+        """Retries one due job, returns False if there is none."""
+        job = self._claim()
+        if job is None:
+            return False
+        user, account, question, attempts = job
+        try:
+            answered = worker(user, account, question)
+        except Exception:
+            get_logger().error(f"retry of question of user {user} failed: ", exc_info=True)
+            answered = False
+        if answered is None:
+            self._release(user, question)
+        else:
+            self._finish(user, question, attempts + 1, answered)
+        return True
+
+    def _run(self, worker: RetryWorker):
+        while True:
+            if not self.run_once(worker):
+                time.sleep(self.poll_interval_seconds)
+
+    def start(self, worker: RetryWorker):
+        self._update_depth()
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._run, args=(worker,), name=f"retry-queue-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from typing import List, Optional
+
+from .bot import Bot, ChatgptBot, UserChats
+from .metrics import get_metrics
+from .retry_queue import RetryQueue
+from .testing import SlowMockBot, StandInProxy
+from .usage_policy import UsagePolicy
+from .wechat_handler import Request, WechatMsg, WechatMsgHandler
+
+
+class RetryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "retry.db")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_backoff_and_give_up(self):
+        queue = RetryQueue(self.path, max_attempts=3, base_delay_seconds=0.01)
+        attempts: List[float] = []
+
+        def failing_worker(user: str, account: str, question: str) -> bool:
+            attempts.append(time.time())
+            return False
+
+        queue.enqueue("a", "account", "你好")
+        self.assertTrue(queue.has_job("a"))
+        deadline = time.time() + 2
+        while queue.has_job("a") and time.time() < deadline:
+            queue.run_once(failing_worker)
+            time.sleep(0.005)
+        self.assertEqual(len(attempts), 3)
+        # waits grow exponentially: ~0.02s, then ~0.04s
+        self.assertGreater(attempts[2] - attempts[1], attempts[1] - attempts[0])
+        self.assertEqual(queue.depth(), 0)
+
+    def test_jobs_survive_restart(self):
+        queue = RetryQueue(self.path, base_delay_seconds=0)
+        queue.enqueue("a", "account", "旧问题")
+        queue.enqueue("a", "account", "新问题")
+        queue.enqueue("b", "account", "你好")
+        queue.cancel("b")
+        # claimed but never finished, as if the process stopped while retrying
+        self.assertIsNotNone(queue._claim())
+        queue.conn.close()
+
+        restarted = RetryQueue(self.path, base_delay_seconds=0)
+        self.assertEqual(restarted.queued_users, {"a"})
+        answered: List[str] = []
+        succeeded = get_metrics().get("retry_queue.succeeded")
+        self.assertTrue(restarted.run_once(lambda user, account, question: answered.append(question) or True))
+        self.assertEqual(answered, ["新问题"])
+        self.assertFalse(restarted.run_once(lambda user, account, question: True))
+        self.assertEqual(get_metrics().get("retry_queue.succeeded"), succeeded + 1)
+        self.assertEqual(get_metrics().get("retry_queue.depth"), 0)
+
+    def test_skip_keeps_attempts(self):
+        queue = RetryQueue(self.path, base_delay_seconds=0)
+        queue.enqueue("a", "account", "你好")
+        handler = WechatMsgHandler(FlakyBot(failures=0), UsagePolicy([]), "", retry_queue=queue)
+        handler.drain(0)
+        for _ in range(3):
+            self.assertTrue(queue.run_once(handler.retry_for_question))
+        self.assertEqual(queue.conn.execute("SELECT attempts, running FROM jobs WHERE user = 'a'").fetchone(), (0, 0))
+        self.assertTrue(queue.has_job("a"))
+        self.assertEqual(handler.bot.questions, [])  # type: ignore
+
+
+class FlakyBot(Bot):
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.questions: List[str] = []
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+        self.questions.append(question)
+        if len(self.questions) <= self.failures:
+            raise IOError("upstream unreachable")
+        return f"answer to {question}"
+
+
+class RetryFailedAnswerTest(unittest.TestCase):
+    def test_answer_later_on_1(self):
+        with tempfile.TemporaryDirectory() as folder:
+            queue = RetryQueue(os.path.join(folder, "retry.db"), base_delay_seconds=0.01, poll_interval_seconds=0.01)
+            bot = FlakyBot(failures=2)
+            handler = WechatMsgHandler(bot, UsagePolicy([]), "", retry_queue=queue)
+
+            def send(text: str) -> str:
+                msg = WechatMsg("account", "a", text)
+                return WechatMsg.from_raw_xml(handler.handle(Request("POST", "/wechat", msg.xml_str())).body).content.text  # type: ignore
+
+            self.assertEqual(send("你好"), handler.retry_queued_msg)
+            self.assertEqual(send("1"), handler.retry_pending_msg_creator(WechatMsg("", "", "")).content.text)  # type: ignore
+            queue.start(handler.retry_for_question)
+            deadline = time.time() + 2
+            while queue.has_job("a") and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(bot.questions, ["你好"] * 3)
+            self.assertEqual(handler.chating_user_answers["a"].content.text, "answer to 你好")  # type: ignore
+
+    def test_new_message_waits_for_retry_in_flight(self):
+        bot = SlowMockBot()
+        handler = WechatMsgHandler(bot, UsagePolicy([]), "")
+        retry = threading.Thread(target=handler.retry_for_question, args=("a", "account", "旧问题"), daemon=True)
+        retry.start()
+        time.sleep(0.1)
+        msg = WechatMsg("account", "a", "新问题")
+        reply = WechatMsg.from_raw_xml(handler.handle(Request("POST", "/wechat", msg.xml_str())).body).content.text  # type: ignore
+        retry.join(5)
+        self.assertEqual(bot.questions, ["旧问题", "新问题"])
+        self.assertEqual(reply, "answer to 新问题")
+        self.assertEqual(handler.chating_user_answers["a"].content.text, "answer to 新问题")  # type: ignore
+        self.assertEqual(handler.chating_users, {})
+
+    def test_no_orphan_question_after_failure(self):
+        upstream = StandInProxy()
+        upstream.failing = True
+        try:
+            chats = UserChats()
+            bot = ChatgptBot("token", chats, url=upstream.url)
+            self.assertEqual(bot.answer("a", "你好"), bot.system_error_msg)
+            self.assertEqual(chats.to_gpt_chats("a"), [])
+            upstream.failing = False
+            self.assertEqual(bot.answer("a", "你好"), "hi")
+            self.assertEqual([m["role"] for m in chats.to_gpt_chats("a")], ["user", "assistant"])
+        finally:
+            upstream.close()
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import json
+import re
+from threading import Lock
+from typing import Dict, List, Optional
+
+from .logger import get_logger
+from .metrics import get_metrics
+
+
+def estimate_tokens(text: str) -> int:
+    # CJK characters are about one token each, other text about four characters per token.
+    cjk_count = len(re.findall(r"[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]", text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+def estimate_prompt_tokens(msgs: List[Dict]) -> int:
+    return sum(estimate_tokens(m["content"]) + 4 for m in msgs) + 2
+
+
+class ModelRoute:
+    def __init__(
+        self,
+        model: str,
+        max_tokens: int,
+        min_tokens: int = 64,
+        context_tokens: int = 4096,
+        tokens_per_second: float = 25.0,
+        latency_overhead_seconds: float = 1.0,
+    ) -> None:
+        self.model = model
+        self.max_tokens = max_tokens
+        # do not route to this model if less than this could be answered in time
+        self.min_tokens = min_tokens
+        self.context_tokens = context_tokens
+        # initial throughput guess, replaced by the observed one once there are answers from the model
+        self.tokens_per_second = tokens_per_second
+        self.latency_overhead_seconds = latency_overhead_seconds
+
+    @staticmethod
+    def from_dict(route: dict) -> ModelRoute:
+        return ModelRoute(**route)
+
+
+class RouteDecision:
+    def __init__(self, model: str, max_tokens: int, prompt_tokens: int, remaining_seconds: float, fallback: bool) -> None:
+        self.model = model
+        self.max_tokens = max_tokens
+        self.prompt_tokens = prompt_tokens
+        self.remaining_seconds = remaining_seconds
+        self.fallback = fallback
+
+    def __str__(self) -> str:
+        return (
+            f"{{model={self.model}, max_tokens={self.max_tokens}, prompt_tokens={self.prompt_tokens}, "
+            f"remaining_seconds={self.remaining_seconds:.2f}, fallback={self.fallback}}}"
+        )
+
+
+class ModelRouter:
+    """Picks the model and max_tokens for a request, so that the answer is likely ready within the time budget.
+
+    Routes are tried in order. The first one that can produce at least `min_tokens` in the remaining time, given
+    its observed tokens-per-second throughput, wins. When none can, the last route (expected to be the fastest)
+    is used with its `min_tokens`.
+    """
+
+    def __init__(self, routes: List[ModelRoute], time_budget_seconds: float = 12.0, ewma_alpha: float = 0.2) -> None:
+        assert routes, "at least one model route is required"
+        self.routes = routes
+        # wechat retries a passive reply 3 times in 15s, answers ready within this budget are delivered in place
+        self.time_budget_seconds = time_budget_seconds
+        self.ewma_alpha = ewma_alpha
+        self.lock = Lock()
+        self.tokens_per_second: Dict[str, float] = {r.model: r.tokens_per_second for r in routes}
+
+    @staticmethod
+    def from_config(config: str) -> ModelRouter:
+        """Config is a json list of routes, or an object with `routes` and optional `time_budget_seconds`."""
+        parsed = json.loads(config)
+        if isinstance(parsed, list):
+            parsed = {"routes": parsed}
+        routes = [ModelRoute.from_dict(r) for r in parsed.pop("routes")]
+        return ModelRouter(routes, **parsed)
+
+    def route(self, msgs: List[Dict], elapsed_seconds: float, max_tokens: Optional[int] = None) -> RouteDecision:
+        prompt_tokens = estimate_prompt_tokens(msgs)
+        remaining_seconds = self.time_budget_seconds - elapsed_seconds
+        decision = None
+        for route in self.routes:
+            tokens = min(route.max_tokens, route.context_tokens - prompt_tokens, max_tokens or route.max_tokens)
+            generation_seconds = remaining_seconds - route.latency_overhead_seconds
+            tokens = min(tokens, int(generation_seconds * self.tokens_per_second[route.model]))
+            if tokens >= route.min_tokens:
+                decision = RouteDecision(route.model, tokens, prompt_tokens, remaining_seconds, fallback=False)
+                break
+        if decision is None:
+            route = self.routes[-1]
+            tokens = max(1, min(route.min_tokens, route.context_tokens - prompt_tokens))
+            decision = RouteDecision(route.model, tokens, prompt_tokens, remaining_seconds, fallback=True)
+        get_logger().info(f"routed request: {decision}")
+        get_metrics().incr(f"router.model.{decision.model}")
+        if decision.fallback:
+            get_metrics().incr("router.fallback")
+        return decision
+
+    def observe(self, model: str, completion_tokens: int, latency_seconds: float):
+        if model not in self.tokens_per_second or completion_tokens <= 0 or latency_seconds <= 0:
+            return
+        with self.lock:
+            tokens_per_second = completion_tokens / latency_seconds
+            self.tokens_per_second[model] += self.ewma_alpha * (tokens_per_second - self.tokens_per_second[model])
+            get_metrics().set(f"router.tokens_per_second.{model}", round(self.tokens_per_second[model], 2))
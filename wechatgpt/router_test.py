@@ -0,0 +1,94 @@
+import time
+import unittest
+
+from .bot import ChatgptBot, UserChats
+from .metrics import get_metrics
+from .request_context import start_request
+from .router import ModelRoute, ModelRouter, estimate_tokens
+from .testing import StandInProxy
+
+
+class ModelRouterTest(unittest.TestCase):
+    def create_router(self) -> ModelRouter:
+        return ModelRouter.from_config(
+            """{
+                "time_budget_seconds": 12,
+                "routes": [
+                    {"model": "slow-model", "max_tokens": 1000, "min_tokens": 200, "tokens_per_second": 20, "latency_overhead_seconds": 2},
+                    {"model": "fast-model", "max_tokens": 1000, "min_tokens": 50, "tokens_per_second": 100, "latency_overhead_seconds": 1}
+                ]
+            }"""
+        )
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens("你好，世界"), 5)
+        self.assertEqual(estimate_tokens("hello world!"), 3)
+
+    def test_route_by_remaining_time(self):
+        router = self.create_router()
+        msgs = [{"role": "user", "content": "hi"}]
+        decision = router.route(msgs, elapsed_seconds=0)
+        self.assertEqual((decision.model, decision.max_tokens), ("slow-model", 200))
+        self.assertFalse(decision.fallback)
+
+        decision = router.route(msgs, elapsed_seconds=3)
+        self.assertEqual((decision.model, decision.max_tokens), ("fast-model", 800))
+
+        decision = router.route(msgs, elapsed_seconds=11.5)
+        self.assertEqual((decision.model, decision.max_tokens), ("fast-model", 50))
+        self.assertTrue(decision.fallback)
+        self.assertGreaterEqual(get_metrics().get("router.fallback"), 1)
+
+    def test_route_respects_requested_max_tokens_and_context(self):
+        router = ModelRouter([ModelRoute("model", max_tokens=1000, min_tokens=10, context_tokens=120, tokens_per_second=1000)])
+        msgs = [{"role": "user", "content": "a" * 400}]
+        self.assertEqual(router.route(msgs, elapsed_seconds=0).max_tokens, 14)
+        self.assertEqual(router.route([], elapsed_seconds=0, max_tokens=30).max_tokens, 30)
+
+    def test_observe_throughput(self):
+        router = self.create_router()
+        for _ in range(20):
+            router.observe("slow-model", completion_tokens=500, latency_seconds=5)
+        self.assertAlmostEqual(router.tokens_per_second["slow-model"], 100, delta=2)
+        decision = router.route([{"role": "user", "content": "hi"}], elapsed_seconds=0)
+        self.assertEqual(decision.model, "slow-model")
+        self.assertGreater(decision.max_tokens, 900)
+        router.observe("unknown-model", completion_tokens=500, latency_seconds=5)
+        self.assertNotIn("unknown-model", router.tokens_per_second)
+
+
+class ChatgptBotRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.upstream = StandInProxy()
+        start_request()
+
+    def tearDown(self):
+        self.upstream.close()
+
+    def test_no_max_tokens_without_routes(self):
+        ChatgptBot("token", UserChats(), url=self.upstream.url).answer("a", "你好")
+        self.assertEqual(self.upstream.last_request["model"], "gpt-3.5-turbo")  # type: ignore
+        self.assertNotIn("max_tokens", self.upstream.last_request)  # type: ignore
+
+    def test_routed_max_tokens(self):
+        router = ModelRouter([ModelRoute("model", max_tokens=300, tokens_per_second=100)])
+        ChatgptBot("token", UserChats(), url=self.upstream.url, router=router).answer("a", "你好")
+        self.assertEqual((self.upstream.last_request["model"], self.upstream.last_request["max_tokens"]), ("model", 300))  # type: ignore
+
+    def test_truncated_answer(self):
+        chats = UserChats()
+        bot = ChatgptBot("token", chats, url=self.upstream.url, max_tokens=5)
+        self.upstream.finish_reason = "length"
+        self.assertEqual(bot.answer("a", "讲个长故事"), "hi" + bot.truncated_hint)
+        self.assertEqual(chats.to_gpt_chats("a")[-1]["content"], "hi")
+
+    def test_delayed_request_gets_fewer_tokens(self):
+        def create_bot() -> ChatgptBot:
+            return ChatgptBot("token", UserChats(), url=self.upstream.url, router=ModelRouter([ModelRoute("model", max_tokens=1000, tokens_per_second=100)]))
+
+        create_bot().answer("a", "你好")
+        self.assertEqual(self.upstream.last_request["max_tokens"], 1000)  # type: ignore
+        # e.g. waited in the merge window and the upstream queue
+        start_request(time.time() - 8)
+        create_bot().answer("a", "你好")
+        self.assertAlmostEqual(self.upstream.last_request["max_tokens"], 300, delta=5)  # type: ignore
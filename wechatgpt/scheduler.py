@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import time
+from threading import Condition
+from typing import Callable, Dict, List, Optional
+
+from .bot import Bot, BusyError
+from .logger import get_logger
+from .tracing import get_tracer
+from .usage_policy import UserTier
+
+
+class TierPolicy:
+    def __init__(
+        self,
+        weight: float,
+        max_wait_seconds: float,
+        max_queue_size: Optional[int] = None,
+        degraded_max_tokens: Optional[int] = None,
+    ) -> None:
+        self.weight = weight
+        self.max_wait_seconds = max_wait_seconds
+        # queued requests of this tier beyond this size get the busy reply at once
+        self.max_queue_size = max_queue_size
+        # max_tokens used for this tier when the upstream is saturated, None to keep the bot default
+        self.degraded_max_tokens = degraded_max_tokens
+
+
+def default_tier_policies() -> Dict[str, TierPolicy]:
+    return {
+        UserTier.ADMIN: TierPolicy(weight=4, max_wait_seconds=30),
+        UserTier.WHITE_LIST: TierPolicy(weight=2, max_wait_seconds=15),
+        UserTier.DEFAULT: TierPolicy(weight=1, max_wait_seconds=3, max_queue_size=20, degraded_max_tokens=256),
+    }
+
+
+class _Job:
+    def __init__(self, user: str, tier: str, finish_tag: float, seq: int) -> None:
+        self.user, self.tier = user, tier
+        self.finish_tag, self.seq = finish_tag, seq
+        self.dispatched = False
+        self.cancelled = False
+
+    def __lt__(self, other: _Job) -> bool:
+        return (self.finish_tag, self.seq) < (other.finish_tag, other.seq)
+
+
+class PriorityScheduledBot(Bot):
+    """Limits concurrent upstream calls and dispatches waiting ones by weighted fair queuing.
+
+    Every waiting request gets a virtual finish tag of `max(virtual_time, user's last tag) + 1 / tier weight`,
+    so higher tiers are dispatched more often and a single user can't crowd out the others of the same tier.
+    Under saturation, requests of tiers with `degraded_max_tokens` are answered with fewer tokens, and
+    requests waiting longer than their tier allows get a `BusyError` with the busy reply.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        user_tier: Callable[[str], str],
+        max_concurrency: int = 8,
+        tier_policies: Optional[Dict[str, TierPolicy]] = None,
+    ) -> None:
+        self.bot = bot
+        self.user_tier = user_tier
+        self.max_concurrency = max_concurrency
+        self.tier_policies = tier_policies or default_tier_policies()
+        self.busy_msg = "抱歉，当前使用人数较多，请稍候再试！"
+        self.cond = Condition()
+        self.running = 0
+        self.queue: List[_Job] = []
+        self.queued_count: Dict[str, int] = {}
+        self.virtual_time = 0.0
+        self.user_finish_tags: Dict[str, float] = {}
+        self.seq = itertools.count()
+        self.rejected_count: Dict[str, int] = {}
+        self.degraded_count: Dict[str, int] = {}
+
+    def _tier_policy(self, tier: str) -> TierPolicy:
+        return self.tier_policies.get(tier, self.tier_policies[UserTier.DEFAULT])
+
+    def _reject(self, user: str, tier: str, reason: str) -> BusyError:
+        self.rejected_count[tier] = self.rejected_count.get(tier, 0) + 1
+        get_logger().info(f"upstream saturated, reply busy message to user {user} (tier={tier}): {reason}")
+        return BusyError(self.busy_msg)
+
+    def _enqueue(self, user: str, tier: str, policy: TierPolicy) -> _Job:
+        start_tag = max(self.virtual_time, self.user_finish_tags.get(user, 0.0))
+        job = _Job(user, tier, start_tag + 1.0 / policy.weight, next(self.seq))
+        self.user_finish_tags[user] = job.finish_tag
+        self.queued_count[tier] = self.queued_count.get(tier, 0) + 1
+        heapq.heappush(self.queue, job)
+        return job
+
+    def _dispatch_next(self):
+        while self.queue and self.running < self.max_concurrency:
+            job = heapq.heappop(self.queue)
+            if job.cancelled:
+                continue
+            self.queued_count[job.tier] -= 1
+            self.virtual_time = max(self.virtual_time, job.finish_tag)
+            job.dispatched = True
+            self.running += 1
+        if not self.queue:
+            self.user_finish_tags = {u: tag for u, tag in self.user_finish_tags.items() if tag > self.virtual_time}
+        self.cond.notify_all()
+
+    def _acquire(self, user: str, tier: str, policy: TierPolicy) -> bool:
+        with self.cond:
+            if self.running < self.max_concurrency and not self.queue:
+                self.running += 1
+                return True
+            if policy.max_queue_size is not None and self.queued_count.get(tier, 0) >= policy.max_queue_size:
+                return False
+            job = self._enqueue(user, tier, policy)
+            deadline = time.time() + policy.max_wait_seconds
+            while not job.dispatched:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    job.cancelled = True
+                    self.queued_count[tier] -= 1
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def _release(self):
+        with self.cond:
+            self.running -= 1
+            self._dispatch_next()
+
+    def saturated(self) -> bool:
+        return self.running >= self.max_concurrency or len(self.queue) > 0
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+        tier = self.user_tier(user)
+        policy = self._tier_policy(tier)
+        saturated_on_arrival = self.saturated()
+        with get_tracer().span("schedule_wait"):
+            acquired = self._acquire(user, tier, policy)
+        if not acquired:
+            raise self._reject(user, tier, "queue full or waited too long")
+        try:
+            if (saturated_on_arrival or self.saturated()) and policy.degraded_max_tokens:
+                self.degraded_count[tier] = self.degraded_count.get(tier, 0) + 1
+                max_tokens = min(max_tokens or policy.degraded_max_tokens, policy.degraded_max_tokens)
+                get_logger().info(f"upstream saturated, answer user {user} (tier={tier}) with max_tokens={max_tokens}")
+            if max_tokens:
+                return self.bot.answer(user, question, max_tokens=max_tokens)
+            return self.bot.answer(user, question)
+        finally:
+            self._release()
+
+    def stat(self) -> dict:
+        with self.cond:
+            return {
+                "running_upstream_calls": self.running,
+                "queued_upstream_calls": sum(self.queued_count.values()),
+                "rejected_upstream_calls": sum(self.rejected_count.values()),
+                "degraded_upstream_calls": sum(self.degraded_count.values()),
+            }
@@ -0,0 +1,83 @@
+import threading
+import time
+import unittest
+from typing import List, Optional
+
+from .bot import Bot, BusyError
+from .scheduler import PriorityScheduledBot, TierPolicy
+from .usage_policy import UsagePolicy, UserTier
+
+
+class BlockingBot(Bot):
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.answered: List[str] = []
+        self.max_tokens: List[Optional[int]] = []
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+        self.release.wait(5)
+        self.answered.append(user)
+        self.max_tokens.append(max_tokens)
+        return f"answer to {question}"
+
+
+class PriorityScheduledBotTest(unittest.TestCase):
+    def create_bot(self, max_concurrency: int = 1):
+        up = UsagePolicy(["admin"], user_white_list={"vip"})
+        policies = {
+            UserTier.ADMIN: TierPolicy(weight=4, max_wait_seconds=5),
+            UserTier.WHITE_LIST: TierPolicy(weight=2, max_wait_seconds=5),
+            UserTier.DEFAULT: TierPolicy(weight=1, max_wait_seconds=5, max_queue_size=2, degraded_max_tokens=100),
+        }
+        blocking_bot = BlockingBot()
+        return blocking_bot, PriorityScheduledBot(blocking_bot, up.user_tier, max_concurrency=max_concurrency, tier_policies=policies)
+
+    def start_answer(self, bot: PriorityScheduledBot, user: str, results: dict) -> threading.Thread:
+        def answer():
+            try:
+                results[user] = bot.answer(user, "q")
+            except BusyError as e:
+                results[user] = e
+
+        thread = threading.Thread(target=answer, daemon=True)
+        thread.start()
+        time.sleep(0.05)
+        return thread
+
+    def test_dispatch_by_tier(self):
+        blocking_bot, bot = self.create_bot()
+        results: dict = {}
+        threads = [self.start_answer(bot, user, results) for user in ["first", "free", "vip", "admin"]]
+        self.assertEqual(bot.stat()["queued_upstream_calls"], 3)
+        blocking_bot.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(blocking_bot.answered, ["first", "admin", "vip", "free"])
+        self.assertEqual(results["free"], "answer to q")
+
+    def test_degrade_and_reject_default_tier_under_saturation(self):
+        blocking_bot, bot = self.create_bot()
+        results: dict = {}
+        threads = [self.start_answer(bot, user, results) for user in ["first", "free-1", "free-2", "free-3", "admin"]]
+        self.assertIsInstance(results["free-3"], BusyError)
+        self.assertEqual(results["free-3"].args[0], bot.busy_msg)
+        blocking_bot.release.set()
+        for thread in threads:
+            thread.join(5)
+        max_tokens = dict(zip(blocking_bot.answered, blocking_bot.max_tokens))
+        self.assertEqual(max_tokens["free-1"], 100)
+        self.assertIsNone(max_tokens["admin"])
+        self.assertEqual(bot.stat()["rejected_upstream_calls"], 1)
+        self.assertEqual(bot.stat()["running_upstream_calls"], 0)
+
+    def test_reject_after_max_wait(self):
+        blocking_bot, bot = self.create_bot()
+        bot.tier_policies[UserTier.DEFAULT].max_wait_seconds = 0.1
+        results: dict = {}
+        first = self.start_answer(bot, "admin", results)
+        with self.assertRaises(BusyError):
+            bot.answer("free", "q")
+        blocking_bot.release.set()
+        first.join(5)
+        self.assertEqual(bot.stat()["queued_upstream_calls"], 0)
+        self.assertEqual(bot.answer("free", "q"), "answer to q")
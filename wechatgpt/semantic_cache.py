@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import zlib
+from threading import Lock
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from .bot import Bot, UserChats
+from .logger import get_logger
+from .metrics import get_metrics
+from .tracing import get_tracer
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class HashedNgramEmbedder:
+    """Embeds text as a normalized bag of hashed character n-grams, which is cheap and works for Chinese as well."""
+
+    def __init__(self, dim: int = 512, ngram_sizes: Tuple[int, ...] = (1, 2, 3)) -> None:
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def normalize(self, text: str) -> str:
+        return re.sub(r"[\W_]+", "", text.lower())
+
+    def embed(self, text: str) -> np.ndarray:
+        text = self.normalize(text)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in self.ngram_sizes:
+            for i in range(len(text) - n + 1):
+                # crc32 instead of hash(), so that persisted vectors stay valid across processes
+                h = zlib.crc32(text[i : i + n].encode())
+                vector[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+class SemanticIndex:
+    """A fixed size vector index with random hyperplane LSH for approximate nearest neighbor search.
+
+    Candidates are the entries whose LSH signature is within `max_hamming_distance` bits of the query's, only those
+    are scored with the exact cosine similarity. When full, the oldest entry is overwritten. With `path`, vectors,
+    signatures and a checksum of each slot's question live in memory-mapped files, and questions/answers plus metadata
+    are written on `flush`. Slots changed after the last flush fail the checksum on load and are dropped, so that a
+    vector is never served with the answer previously kept in its slot.
+    """
+
+    def __init__(
+        self,
+        dim: int = 512,
+        capacity: int = 10000,
+        signature_bits: int = 12,
+        max_hamming_distance: int = 3,
+        path: Optional[str] = None,
+        flush_every: int = 20,
+    ) -> None:
+        assert signature_bits <= 32
+        self.dim, self.capacity = dim, capacity
+        self.signature_bits = signature_bits
+        self.max_hamming_distance = max_hamming_distance
+        self.path = path
+        self.flush_every = flush_every
+        self.lock = Lock()
+        # fixed seed, so that persisted signatures stay valid across processes
+        self.hyperplanes = np.random.default_rng(0).standard_normal((signature_bits, dim)).astype(np.float32)
+        self.bit_values = 1 << np.arange(signature_bits, dtype=np.uint64)
+        self.size, self.next_slot, self.unflushed_count = 0, 0, 0
+        self.entries: List[Optional[Tuple[str, str]]] = [None] * capacity
+        if path:
+            self._open(path)
+        else:
+            self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+            self.signatures = np.zeros(capacity, dtype=np.uint32)
+            self.checksums = np.zeros(capacity, dtype=np.uint32)
+
+    def _meta(self) -> dict:
+        return {"dim": self.dim, "capacity": self.capacity, "signature_bits": self.signature_bits, "size": self.size, "next_slot": self.next_slot}
+
+    @staticmethod
+    def _checksum(question: str) -> int:
+        return zlib.crc32(question.encode())
+
+    def _read_persisted(self, path: str) -> Optional[Tuple[dict, List[Optional[Tuple[str, str]]]]]:
+        meta_path, entries_path = os.path.join(path, "meta.json"), os.path.join(path, "entries.json")
+        data_paths = [os.path.join(path, name) for name in ["vectors.f32", "signatures.u32", "checksums.u32"]]
+        if not all(os.path.exists(p) for p in [meta_path, entries_path, *data_paths]):
+            return None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if [meta["dim"], meta["capacity"], meta["signature_bits"]] != [self.dim, self.capacity, self.signature_bits]:
+                get_logger().info(f"semantic cache config changed, will drop the persisted index: {meta}")
+                return None
+            with open(entries_path) as f:
+                entries = [tuple(e) if e else None for e in json.load(f)]
+            assert len(entries) == self.capacity, f"expected {self.capacity} entries, found {len(entries)}"
+            return meta, entries  # type: ignore
+        except Exception:
+            get_logger().error(f"unable to load semantic cache from {path}, will start empty: ", exc_info=True)
+            return None
+
+    def _open(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        persisted = self._read_persisted(path)
+        mode = "r+" if persisted else "w+"
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode=mode, shape=(self.capacity, self.dim))
+        self.signatures = np.memmap(os.path.join(path, "signatures.u32"), dtype=np.uint32, mode=mode, shape=(self.capacity,))
+        self.checksums = np.memmap(os.path.join(path, "checksums.u32"), dtype=np.uint32, mode=mode, shape=(self.capacity,))
+        if persisted:
+            meta, self.entries = persisted
+            self.size, self.next_slot = meta["size"], meta["next_slot"]
+            dropped = 0
+            for slot in range(self.size):
+                entry = self.entries[slot]
+                if entry is None or self.checksums[slot] != self._checksum(entry[0]):
+                    # the slot was overwritten after the entries were last written
+                    self.entries[slot] = None
+                    self.vectors[slot] = 0
+                    dropped += 1
+            get_logger().info(f"loaded semantic cache with {self.size - dropped} entries from {path}, dropped {dropped} unflushed")
+
+    def signature(self, vector: np.ndarray) -> int:
+        bits = (self.hyperplanes @ vector) > 0
+        return int(bits @ self.bit_values)
+
+    def add(self, vector: np.ndarray, question: str, answer: str):
+        with self.lock:
+            slot = self.next_slot
+            self.vectors[slot] = vector
+            self.signatures[slot] = self.signature(vector)
+            self.checksums[slot] = self._checksum(question)
+            self.entries[slot] = (question, answer)
+            self.next_slot = (slot + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.unflushed_count += 1
+            if self.path and self.unflushed_count >= self.flush_every:
+                self._flush()
+
+    def search(self, vector: np.ndarray) -> Optional[Tuple[float, str, str]]:
+        """Returns (similarity, question, answer) of the approximate nearest entry, None if there is no candidate."""
+        with self.lock:
+            if self.size == 0:
+                return None
+            distances = _POPCOUNT[(self.signatures[: self.size] ^ np.uint32(self.signature(vector))).view(np.uint8)].reshape(-1, 4).sum(axis=1)
+            candidates = np.flatnonzero(distances <= self.max_hamming_distance)
+            if len(candidates) == 0:
+                return None
+            similarities = self.vectors[candidates] @ vector
+            best = int(np.argmax(similarities))
+            if self.entries[candidates[best]] is None:
+                return None
+            question, answer = self.entries[candidates[best]]  # type: ignore
+            return float(similarities[best]), question, answer
+
+    def _flush(self):
+        self.unflushed_count = 0
+        if not self.path:
+            return
+        self.vectors.flush()  # type: ignore
+        self.signatures.flush()  # type: ignore
+        self.checksums.flush()  # type: ignore
+        # replaced atomically, a crash while writing leaves the previous files in place
+        for name, data in [("entries.json", self.entries), ("meta.json", self._meta())]:
+            path = os.path.join(self.path, name)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(f"{path}.tmp", path)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+
+class SemanticCacheBot(Bot):
+    """Answers first-turn questions from a semantic cache of previous answers, other questions go to the wrapped bot."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        chats: UserChats,
+        index: Optional[SemanticIndex] = None,
+        embedder: Optional[HashedNgramEmbedder] = None,
+        similarity_threshold: float = 0.9,
+        min_question_length: int = 4,
+        uncacheable_answers: Optional[Set[str]] = None,
+        truncated_hint: Optional[str] = None,
+    ) -> None:
+        self.bot = bot
+        self.chats = chats
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.index = index or SemanticIndex(dim=self.embedder.dim)
+        self.similarity_threshold = similarity_threshold
+        # very short questions like "ok" are too ambiguous to be answered from the cache
+        self.min_question_length = min_question_length
+        self.uncacheable_answers = uncacheable_answers or set()
+        # what the wrapped bot appends to an answer cut at max_tokens, such answers are not cached
+        self.truncated_hint = truncated_hint
+
+    def _is_first_turn(self, user: str) -> bool:
+        self.chats.try_clear_session_chats()
+        return len(self.chats.chats.get(user, [])) <= len(self.chats.initial_msgs)
+
+    def _update_hit_rate(self):
+        metrics = get_metrics()
+        hit, miss = metrics.get("semantic_cache.hit"), metrics.get("semantic_cache.miss")
+        metrics.set("semantic_cache.hit_rate", round(hit / (hit + miss), 4) if hit + miss else 0)
+        metrics.set("semantic_cache.size", self.index.size)
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+        if len(self.embedder.normalize(question)) < self.min_question_length or not self._is_first_turn(user):
+            return self.bot.answer(user, question, max_tokens=max_tokens) if max_tokens else self.bot.answer(user, question)
+
+        with get_tracer().span("semantic_cache"):
+            vector = self.embedder.embed(question)
+            found = self.index.search(vector)
+        if found and found[0] >= self.similarity_threshold:
+            similarity, cached_question, answer = found
+            get_logger().info(f"semantic cache hit for user {user} (similarity={similarity:.3f}, cached question: {cached_question})")
+            get_metrics().incr("semantic_cache.hit")
+            self._update_hit_rate()
+            self.chats.add_user_chat(user, question)
+            self.chats.add_assistant_chat(user, answer, 0)
+            return answer
+
+        get_metrics().incr("semantic_cache.miss")
+        self._update_hit_rate()
+        answer = self.bot.answer(user, question, max_tokens=max_tokens) if max_tokens else self.bot.answer(user, question)
+        if self._is_cacheable(answer, max_tokens):
+            self.index.add(vector, question, answer)
+        return answer
+
+    def _is_cacheable(self, answer: str, max_tokens: Optional[int]) -> bool:
+        # an answer limited by the caller's max_tokens may be shorter than what others asking the same would get
+        if not isinstance(answer, str) or not answer or max_tokens or answer in self.uncacheable_answers:
+            return False
+        return not (self.truncated_hint and answer.endswith(self.truncated_hint))
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from typing import List, Optional
+
+from .bot import Bot, UserChats
+from .metrics import get_metrics
+from .semantic_cache import HashedNgramEmbedder, SemanticCacheBot, SemanticIndex
+
+
+class CountingBot(Bot):
+    def __init__(self, chats: UserChats) -> None:
+        self.chats = chats
+        self.questions: List[str] = []
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+        self.questions.append(question)
+        self.chats.add_user_chat(user, question)
+        self.chats.add_assistant_chat(user, f"answer to {question}", 10)
+        return f"answer to {question}"
+
+
+class SemanticCacheTest(unittest.TestCase):
+    def test_embedding_similarity(self):
+        embedder = HashedNgramEmbedder()
+        similar = embedder.embed("如何学习Python编程？") @ embedder.embed("如何学习 python 编程")
+        different = embedder.embed("如何学习Python编程？") @ embedder.embed("今天天气怎么样")
+        self.assertGreater(similar, 0.99)
+        self.assertLess(different, 0.3)
+
+    def test_index_capacity_and_persistence(self):
+        embedder = HashedNgramEmbedder()
+        with tempfile.TemporaryDirectory() as path:
+            index = SemanticIndex(capacity=2, path=path, flush_every=100)
+            for question in ["什么是机器学习", "怎么做红烧肉", "如何学习英语口语"]:
+                index.add(embedder.embed(question), question, f"answer to {question}")
+            self.assertEqual(index.size, 2)
+            evicted = index.search(embedder.embed("什么是机器学习"))
+            self.assertTrue(evicted is None or evicted[1] != "什么是机器学习")
+            found = index.search(embedder.embed("怎么做红烧肉？"))
+            self.assertIsNotNone(found)
+            self.assertEqual(found[2], "answer to 怎么做红烧肉")  # type: ignore
+            index.flush()
+
+            reloaded = SemanticIndex(capacity=2, path=path)
+            self.assertEqual(reloaded.size, 2)
+            found = reloaded.search(embedder.embed("如何学习英语口语"))
+            self.assertEqual(found[1], "如何学习英语口语")  # type: ignore
+            self.assertGreater(found[0], 0.99)  # type: ignore
+
+            self.assertEqual(SemanticIndex(capacity=3, path=path).size, 0)
+
+    def test_drop_slots_overwritten_after_flush(self):
+        embedder = HashedNgramEmbedder()
+        with tempfile.TemporaryDirectory() as path:
+            index = SemanticIndex(capacity=3, path=path, flush_every=3)
+            for question in ["什么是机器学习", "怎么做红烧肉", "如何学习英语口语", "今天天气怎么样"]:
+                index.add(embedder.embed(question), question, f"answer to {question}")
+
+            # the process stops before the entry of the 4th question, which overwrote the 1st, is written
+            reloaded = SemanticIndex(capacity=3, path=path)
+            for question in ["今天天气怎么样", "什么是机器学习"]:
+                found = reloaded.search(embedder.embed(question))
+                self.assertTrue(found is None or found[0] < 0.5, found)
+            self.assertEqual(reloaded.search(embedder.embed("怎么做红烧肉"))[2], "answer to 怎么做红烧肉")  # type: ignore
+
+            with open(os.path.join(path, "entries.json"), "w") as f:
+                f.write('[["什么是')
+            self.assertEqual(SemanticIndex(capacity=3, path=path).size, 0)
+
+    def test_cache_first_turn_questions(self):
+        chats = UserChats()
+        counting_bot = CountingBot(chats)
+        bot = SemanticCacheBot(counting_bot, chats, uncacheable_answers={"answer to 出错了吗"})
+        hit_count = get_metrics().get("semantic_cache.hit")
+
+        self.assertEqual(bot.answer("user-1", "如何学习Python编程？"), "answer to 如何学习Python编程？")
+        self.assertEqual(bot.answer("user-2", "如何学习 python 编程"), "answer to 如何学习Python编程？")
+        self.assertEqual(counting_bot.questions, ["如何学习Python编程？"])
+        self.assertEqual(get_metrics().get("semantic_cache.hit"), hit_count + 1)
+        self.assertEqual(len(chats.chats["user-2"]), 2)
+
+        # follow up questions depend on the session, they always go to the bot
+        bot.answer("user-2", "如何学习 python 编程")
+        self.assertEqual(len(counting_bot.questions), 2)
+
+        bot.answer("user-3", "出错了吗")
+        bot.answer("user-4", "出错了吗")
+        self.assertEqual(counting_bot.questions[-2:], ["出错了吗", "出错了吗"])
+
+    def test_skip_limited_answers(self):
+        chats = UserChats()
+        counting_bot = CountingBot(chats)
+        bot = SemanticCacheBot(counting_bot, chats, truncated_hint="（未完）")
+        counting_bot.answer = lambda user, question, max_tokens=None: CountingBot.answer(counting_bot, user, question) + "（未完）"  # type: ignore
+        bot.answer("user-1", "讲一个很长的故事")
+        bot.answer("user-2", "讲一个很长的故事")
+        self.assertEqual(len(counting_bot.questions), 2)
+
+        bot = SemanticCacheBot(CountingBot(chats), chats)
+        bot.answer("user-3", "什么是机器学习", max_tokens=10)
+        self.assertEqual(bot.index.size, 0)
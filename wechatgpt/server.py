@@ -1,23 +1,35 @@
+from __future__ import annotations
+
+import atexit
+import hmac
 import sys
 import traceback
 import uuid
 import logging
-import os
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple, Union
 
-from flask import Flask, make_response
+from flask import Flask, has_request_context, jsonify, make_response
 from flask import request as flask_request
 from flask import Request as FlaskRequest
 from . import logger as commonLogger
 
-from .wechat_handler import Request, Response, WechatEchoMsgHandler, WechatMsgHandler, UsagePolicy, check_signature
-from .bot import ChatgptBot, UserChats
+from .config import ServerConfig
+from .tracing import get_tracer
+from .traffic import TrafficRecorder
+
+if TYPE_CHECKING:
+    from .wechat_handler import WechatEchoMsgHandler, WechatMsgHandler
 
 
 class RequestFormatter(logging.Formatter):
     def format(self, record):
-        record.url = flask_request.path
-        record.request_id = flask_request.request_id  # type: ignore
-        record.remote_addr = flask_request.remote_addr
+        if has_request_context():
+            record.url = flask_request.path
+            record.request_id = flask_request.request_id  # type: ignore
+            record.remote_addr = flask_request.remote_addr
+        else:
+            record.url = record.request_id = record.remote_addr = "-"
         return super(RequestFormatter, self).format(record)
 
 
@@ -29,48 +41,189 @@ class LoggingHelpFlaskRequest(FlaskRequest):
 
 Flask.request_class = LoggingHelpFlaskRequest
 
-app = Flask("wechatgpt")
-logger = app.logger
-commonLogger.set_logger(logger)
-
 
-bot = ChatgptBot(os.environ["chat_gpt_token"], UserChats(), os.environ["http_proxy"])
-up = UsagePolicy(
-    os.environ["admin_user_ids"].split(","), user_white_list=set(os.environ["white_list_user_ids"].split(",")), token=os.environ["token"]
-)
-admin_email = os.environ["admin_email"]
-wechat_token = os.environ["wechat_token"]
-wechat_msg_handler = WechatMsgHandler(bot, up, admin_email)
-wechat_echo_handler = WechatEchoMsgHandler()
-
-
-@app.route("/wechat", methods=["GET", "POST"])
-def wechat():
-    request = Request(
-        flask_request.method,
-        flask_request.full_path,
-        flask_request.stream.read().decode("utf8"),
+def build_handlers(config: ServerConfig, recorder: Optional[TrafficRecorder] = None) -> Tuple[WechatMsgHandler, WechatEchoMsgHandler]:
+    # heavy modules (lxml, requests, numpy) are imported here, so that importing this module stays cheap.
+    from .bot import Bot, ChatgptBot, UserChats
+    from .ledger import TokenLedger
+    from .prefilter import MessagePrefilter
+    from .proxy_pool import ProxyPool
+    from .retry_queue import RetryQueue
+    from .router import ModelRouter
+    from .scheduler import PriorityScheduledBot
+    from .snapshot import StateSnapshot
+    from .wechat_handler import UsagePolicy, WechatEchoMsgHandler, WechatMsgHandler
+
+    # called on drain before a restart, and at exit in case the process is stopped without draining
+    flushes: List[Callable[[], Optional[dict]]] = []
+    ledger = TokenLedger(config.ledger_dir) if config.ledger_dir else None
+    if ledger is not None:
+        flushes.append(ledger.flush)
+    up = UsagePolicy(
+        config.admin_user_ids,
+        user_white_list=set(config.white_list_user_ids),
+        token=config.token,
+        ledger=ledger,
+        default_user_tokens_per_day=config.user_tokens_per_day,
     )
-    logger.info("request received: %s", request)
-    try:
-        if flask_request.method == "POST":
-            sig = flask_request.args.get("signature", "")
-            timestamp = flask_request.args.get("timestamp", "")
-            nonce = flask_request.args.get("nonce", "")
-            if check_signature(wechat_token, sig, timestamp, nonce):
-                response = wechat_msg_handler.handle(request)
+    user_chats = UserChats()
+    proxy: Optional[Union[str, ProxyPool]] = config.http_proxy
+    if len(config.http_proxies) > 1:
+        proxy = ProxyPool(config.http_proxies)
+        proxy.start()
+    chatgpt_bot = ChatgptBot(
+        config.chat_gpt_token,
+        user_chats,
+        proxy,
+        router=ModelRouter.from_config(config.model_routes) if config.model_routes else None,
+        ledger=ledger,
+        url=config.chat_gpt_url,
+        recorder=recorder,
+    )
+    scheduled_bot = PriorityScheduledBot(chatgpt_bot, up.user_tier, max_concurrency=config.max_upstream_concurrency)
+    bot: Bot = scheduled_bot
+    if config.semantic_cache_dir:
+        from .semantic_cache import SemanticCacheBot, SemanticIndex
+
+        index = SemanticIndex(capacity=config.semantic_cache_size, path=config.semantic_cache_dir)
+        flushes.append(index.flush)
+        bot = SemanticCacheBot(
+            bot,
+            user_chats,
+            index,
+            similarity_threshold=config.semantic_cache_threshold,
+            uncacheable_answers={chatgpt_bot.system_error_msg, chatgpt_bot.token_exceeded_msg},
+            truncated_hint=chatgpt_bot.truncated_hint,
+        )
+    prefilter = MessagePrefilter(config.prefilter_path) if config.prefilter_path else None
+    retry_queue = RetryQueue(config.retry_queue_path, max_workers=config.max_retry_workers) if config.retry_queue_path else None
+    msg_handler = WechatMsgHandler(
+        bot,
+        up,
+        config.admin_email,
+        merge_window_ms=config.merge_window_ms,
+        prefilter=prefilter,
+        retry_queue=retry_queue,
+        retryable_answers={chatgpt_bot.system_error_msg},
+    )
+    if config.snapshot_path:
+        state_snapshot = StateSnapshot(config.snapshot_path)
+        state_snapshot.register("user_chats", user_chats)
+        state_snapshot.register("usage_policy", up)
+        state_snapshot.register("wechat_handler", msg_handler)
+        state_snapshot.restore()
+        flushes.append(state_snapshot.write)
+    for flush in flushes:
+        msg_handler.drain_flushes.append(flush)
+        atexit.register(flush)
+    if retry_queue is not None:
+        retry_queue.start(msg_handler.retry_for_question)
+    return msg_handler, WechatEchoMsgHandler()
+
+
+class LazyHandlers:
+    """Builds the handlers (and the threads they start) on first use, which is after uWSGI forked the worker."""
+
+    def __init__(self, config: ServerConfig, recorder: Optional[TrafficRecorder] = None) -> None:
+        self.config = config
+        self.recorder = recorder
+        self.lock = Lock()
+        self.handlers: Optional[Tuple[WechatMsgHandler, WechatEchoMsgHandler]] = None
+
+    def get(self) -> Tuple[WechatMsgHandler, WechatEchoMsgHandler]:
+        if self.handlers is None:
+            with self.lock:
+                if self.handlers is None:
+                    self.handlers = build_handlers(self.config, self.recorder)
+        return self.handlers
+
+
+def create_app(config: Optional[ServerConfig] = None) -> Flask:
+    config = config or ServerConfig.from_env()
+    app = Flask("wechatgpt")
+    logger = app.logger
+    commonLogger.set_logger(logger)
+    recorder = None
+    if config.traffic_capture_path:
+        # keyed by the admin token, so that the same text gets the same placeholder across restarts
+        recorder = TrafficRecorder(config.traffic_capture_path, redact_content=not config.traffic_capture_plaintext, redaction_key=config.token)
+    handlers = LazyHandlers(config, recorder)
+    app.extensions["wechatgpt_handlers"] = handlers
+
+    @app.route("/wechat", methods=["GET", "POST"])
+    def wechat():
+        from .wechat_handler import Request, Response, check_signature
+
+        get_tracer().start_trace(flask_request.path)
+        wechat_msg_handler, wechat_echo_handler = handlers.get()
+        request = Request(
+            flask_request.method,
+            flask_request.full_path,
+            flask_request.stream.read().decode("utf8"),
+        )
+        logger.info("request received: %s", request)
+        try:
+            if flask_request.method == "POST":
+                sig = flask_request.args.get("signature", "")
+                timestamp = flask_request.args.get("timestamp", "")
+                nonce = flask_request.args.get("nonce", "")
+                if check_signature(config.wechat_token, sig, timestamp, nonce):
+                    if recorder is not None:
+                        recorder.record_request(request.method, request.body, wechat_msg_handler.is_command)
+                    response = wechat_msg_handler.handle(request)
+                else:
+                    response = Response(None, 403, "")
             else:
-                response = Response(None, 403, "")
-        else:
-            response = wechat_echo_handler.handle(request)
-    except Exception as e:
-        traceback.print_exc()
-        response = Response(None, 500, "")
-    res = make_response(response.body, response.status_code)
-    for k, v in response.headers.items():
-        res.headers[k] = v
-    logger.info("request handled: %s", response)
-    return res
+                response = wechat_echo_handler.handle(request)
+        except Exception as e:
+            traceback.print_exc()
+            response = Response(None, 500, "")
+        res = make_response(response.body, response.status_code)
+        for k, v in response.headers.items():
+            res.headers[k] = v
+        logger.info("request handled: %s", response)
+        get_tracer().finish_trace()
+        return res
+
+    def is_admin_request(wechat_msg_handler: WechatMsgHandler) -> bool:
+        token = wechat_msg_handler.usage_policy.token
+        return bool(token) and hmac.compare_digest(flask_request.args.get("token", ""), token)
+
+    @app.route("/admin/drain", methods=["POST"])
+    def drain():
+        # called by `make deploy` right before the container is stopped
+        wechat_msg_handler, _ = handlers.get()
+        if not is_admin_request(wechat_msg_handler):
+            return make_response("", 403)
+        try:
+            timeout_seconds = min(float(flask_request.args.get("timeout", "10")), 60)
+        except ValueError:
+            return make_response("invalid timeout", 400)
+        result = wechat_msg_handler.drain(timeout_seconds)
+        logger.info("drain finished: %s", result)
+        return jsonify(result)
+
+    @app.route("/admin/undrain", methods=["POST"])
+    def undrain():
+        # e.g. the deploy failed after draining and the old container keeps serving
+        wechat_msg_handler, _ = handlers.get()
+        if not is_admin_request(wechat_msg_handler):
+            return make_response("", 403)
+        wechat_msg_handler.undrain()
+        logger.info("undrained, answering new questions again")
+        return jsonify({"draining": False})
+
+    _set_logger(app)
+    _warm_up_after_fork(handlers)
+    return app
+
+
+def _warm_up_after_fork(handlers: LazyHandlers):
+    try:
+        from uwsgidecorators import postfork  # type: ignore
+    except ImportError:
+        return
+    postfork(handlers.get)
 
 
 def _set_logger(flaskapp):
@@ -78,16 +231,22 @@ def _set_logger(flaskapp):
     handler = logging.StreamHandler(sys.stdout)
     if flaskapp.config.get("DEBUG"):
         handler.setLevel(logging.DEBUG)
-        app.logger.setLevel(logging.DEBUG)
+        flaskapp.logger.setLevel(logging.DEBUG)
     else:
         handler.setLevel(logging.INFO)
-        app.logger.setLevel(logging.INFO)
+        flaskapp.logger.setLevel(logging.INFO)
     handler.setFormatter(
         RequestFormatter(
             "[%(asctime)s][%(processName)s:%(threadName)s][%(levelname)s][%(remote_addr)s][%(request_id)s][%(url)s][%(module)s.%(funcName)s:%(lineno)d]: %(message)s"
         )
     )
-    app.logger.addHandler(handler)
+    flaskapp.logger.addHandler(handler)
 
 
-_set_logger(app)
+def __getattr__(name: str):
+    # `wechatgpt.server:app` for uWSGI and flask, created from the environment when first accessed.
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__} has no attribute {name}")
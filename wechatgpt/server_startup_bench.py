@@ -0,0 +1,45 @@
+"""Measures how fast a fresh worker becomes ready: importing the server module, creating the app and the first request.
+
+Run with `python -m wechatgpt.server_startup_bench [rounds]`. Every round runs in a new interpreter, so module imports
+are measured cold.
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+ROUND_SCRIPT = """
+import json, time
+started_at = time.perf_counter()
+from wechatgpt.server import create_app
+from wechatgpt.config import ServerConfig
+imported_at = time.perf_counter()
+app = create_app(ServerConfig.from_env({
+    "chat_gpt_token": "gpt-token", "token": "admin-token", "wechat_token": "wechat-token",
+    "admin_user_ids": "admin", "admin_email": "admin@example.com",
+}))
+created_at = time.perf_counter()
+response = app.test_client().get("/wechat?echostr=ready")
+assert response.data == b"ready"
+ready_at = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported_at - started_at) * 1000,
+    "create_app_ms": (created_at - imported_at) * 1000,
+    "first_request_ms": (ready_at - created_at) * 1000,
+    "total_ms": (ready_at - started_at) * 1000,
+}))
+"""
+
+
+def run(rounds: int = 10):
+    results = []
+    for _ in range(rounds):
+        output = subprocess.run([sys.executable, "-c", ROUND_SCRIPT], check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    for key in results[0]:
+        values = [r[key] for r in results]
+        print(f"{key:>18}: median={statistics.median(values):8.2f} min={min(values):8.2f} max={max(values):8.2f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,64 @@
+"""Measures how long writing and restoring the state snapshot takes, and how large it gets.
+
+Run with `python -m wechatgpt.snapshot_bench [users]`, 100k users by default. Every user has a session of 4 messages,
+chat stats and a recent answer, and one in a hundred users has unread answer pages.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from .bot import UserChats
+from .snapshot import StateSnapshot
+from .usage_policy import UsagePolicy
+from .wechat_handler import WechatMsg, WechatMsgHandler
+
+
+def create_state(users: int):
+    user_chats = UserChats()
+    up = UsagePolicy(["admin"])
+    handler = WechatMsgHandler(None, up, "")  # type: ignore
+    for i in range(users):
+        user = f"oQ2Lx5pNq8rT3vW9yZ1bC4dE{i:07d}"
+        for turn in range(2):
+            user_chats.add_user_chat(user, f"问题 {turn}：请帮我解释一下这个概念是什么意思？")
+            user_chats.add_assistant_chat(user, "这是一个比较常见的概念，简单来说，它指的是……" * 4, 300 * (turn + 1))
+        up.on_chat(user)
+        handler.chating_user_answers[user] = WechatMsg(user, "account", "这是一个比较常见的概念。" * 8)
+        if i % 100 == 0:
+            handler.pager.paginate(user, "很长的回答。" * 600)
+    return user_chats, up, handler
+
+
+def timed(f) -> float:
+    started_at = time.perf_counter()
+    f()
+    return (time.perf_counter() - started_at) * 1000
+
+
+def run(users: int = 100000):
+    # keep the per message logs of building the state out of the output
+    import logging
+
+    from . import logger
+
+    logger.get_logger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "snapshot.json")
+        snapshot = StateSnapshot(path)
+        for name, part in zip(["user_chats", "usage_policy", "wechat_handler"], create_state(users)):
+            snapshot.register(name, part)
+        write_ms = timed(snapshot.write)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+
+        restored = StateSnapshot(path)
+        user_chats, up, handler = UserChats(), UsagePolicy(["admin"]), WechatMsgHandler(None, UsagePolicy([]), "")  # type: ignore
+        for name, part in zip(["user_chats", "usage_policy", "wechat_handler"], [user_chats, up, handler]):
+            restored.register(name, part)
+        restore_ms = timed(restored.restore)
+        assert len(user_chats.chats) == users and len(up.user_chat_stat) == users
+    print(f"users={users} snapshot={size_mb:.1f}MB write={write_ms:.0f}ms restore={restore_ms:.0f}ms")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,127 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from typing import List
+
+from .bot import ChatMessage, UserChats
+from .snapshot import StateSnapshot
+from .testing import SlowMockBot
+from .usage_policy import UsagePolicy
+from .wechat_handler import Request, WechatMsg, WechatMsgHandler
+
+
+def create_snapshot(path: str, user_chats: UserChats, up: UsagePolicy, handler: WechatMsgHandler) -> StateSnapshot:
+    snapshot = StateSnapshot(path)
+    snapshot.register("user_chats", user_chats)
+    snapshot.register("usage_policy", up)
+    snapshot.register("wechat_handler", handler)
+    return snapshot
+
+
+class StateSnapshotTest(unittest.TestCase):
+    def test_write_and_restore(self):
+        initial_msgs = [ChatMessage("system", "you are a helpful assistant", 0)]
+        user_chats = UserChats(initial_msgs=initial_msgs)
+        user_chats.add_user_chat("a", "你好")
+        user_chats.add_assistant_chat("a", "你好呀", 20)
+        up = UsagePolicy(["admin", "removed-admin"])
+        up.add_white_list("b")
+        up.set_limit("c", 50)
+        for user in ["a", "a", "c"]:
+            up.on_chat(user)
+        handler = WechatMsgHandler(SlowMockBot(), up, "")
+        handler.chating_user_answers["a"] = WechatMsg("a", "account", "你好呀")
+        handler.pager.paginate("c", "很长的回答。" * 1000)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "state", "snapshot.json")
+            create_snapshot(path, user_chats, up, handler).write()
+
+            restored_chats = UserChats(initial_msgs=initial_msgs)
+            restored_up = UsagePolicy(["admin"])
+            restored_handler = WechatMsgHandler(SlowMockBot(), restored_up, "")
+            self.assertTrue(create_snapshot(path, restored_chats, restored_up, restored_handler).restore())
+
+        self.assertEqual(restored_chats.to_gpt_chats("a"), user_chats.to_gpt_chats("a"))
+        self.assertEqual(restored_chats.chat_tokens["a"], 20)
+        self.assertEqual(restored_up.get_stat({}), up.get_stat({}))
+        self.assertEqual(restored_up.get_hourly_stat(), up.get_hourly_stat())
+        self.assertEqual(restored_up.user_chat_stat["a"].chat_count, 2)
+        self.assertEqual(restored_up.user_chat_stat["a"].last_chat_at, up.user_chat_stat["a"].last_chat_at)
+        # privileges come from the config of the restored server only
+        self.assertEqual(restored_up.user_white_list, {"admin"})
+        self.assertEqual(restored_up.user_chat_count_per_day, {"c": 50})
+        answer = restored_handler.chating_user_answers["a"]
+        self.assertEqual((answer.to_user_name, answer.from_user_name, answer.content.text), ("a", "account", "你好呀"))  # type: ignore
+        self.assertEqual(restored_handler.pager.next_page("c"), handler.pager.next_page("c"))
+
+    def test_start_cold_on_broken_snapshot(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "snapshot.json")
+            user_chats = UserChats()
+            snapshot = StateSnapshot(path)
+            snapshot.register("user_chats", user_chats)
+            self.assertFalse(snapshot.restore())
+            with open(path, "w") as f:
+                f.write('{"version": 1, "user_chats": {"chats": {"a": [["user"')
+            self.assertFalse(snapshot.restore())
+        self.assertEqual(user_chats.chats, {})
+
+
+class DrainTest(unittest.TestCase):
+    def test_drain(self):
+        bot = SlowMockBot()
+        handler = WechatMsgHandler(bot, UsagePolicy([]), "")
+
+        def send(user: str, text: str) -> str:
+            msg = WechatMsg("account", user, text)
+            return WechatMsg.from_raw_xml(handler.handle(Request("POST", "/wechat", msg.xml_str())).body).content.text  # type: ignore
+
+        in_flight = threading.Thread(target=send, args=("a", "你好"), daemon=True)
+        in_flight.start()
+        time.sleep(0.1)
+        with tempfile.TemporaryDirectory() as folder:
+            flushed: List[str] = []
+            handler.drain_flushes.append(lambda: flushed.append("ledger"))  # type: ignore
+            handler.drain_flushes.append(create_snapshot(os.path.join(folder, "snapshot.json"), UserChats(), handler.usage_policy, handler).write)
+            result = handler.drain(5)
+            self.assertGreater(result["snapshot_bytes"], 0)
+            self.assertEqual(flushed, ["ledger"])
+        in_flight.join()
+        self.assertTrue(result["drained"])
+        self.assertEqual(handler.chating_user_answers["a"].content.text, "answer to 你好")  # type: ignore
+        self.assertEqual(send("b", "在吗"), handler.restarting_msg_creator(WechatMsg("", "", "")).content.text)  # type: ignore
+        self.assertEqual(bot.questions, ["你好"])
+
+        handler.undrain()
+        self.assertEqual(send("b", "在吗"), "answer to 在吗")
+
+    def test_no_new_upstream_calls_for_chatting_user(self):
+        bot = SlowMockBot()
+        handler = WechatMsgHandler(bot, UsagePolicy([]), "")
+        replies: List[str] = []
+
+        def send(text: str):
+            msg = WechatMsg("account", "a", text)
+            replies.append(WechatMsg.from_raw_xml(handler.handle(Request("POST", "/wechat", msg.xml_str())).body).content.text)  # type: ignore
+
+        threads = [threading.Thread(target=send, args=("你好",), daemon=True)]
+        threads[0].start()
+        time.sleep(0.1)
+        # waits for its own turn after the answer in flight
+        threads.append(threading.Thread(target=send, args=("第二个问题",), daemon=True))
+        threads[1].start()
+        time.sleep(0.05)
+        draining = threading.Thread(target=handler.drain, args=(5,), daemon=True)
+        draining.start()
+        time.sleep(0.05)
+        send("第三个问题")
+        for thread in threads + [draining]:
+            thread.join(5)
+        restarting = handler.restarting_msg_creator(WechatMsg("", "", "")).content.text  # type: ignore
+        self.assertEqual(bot.questions, ["你好"])
+        self.assertCountEqual(replies, ["answer to 你好", restarting, restarting])
+        self.assertEqual(handler.chating_users, {})
+
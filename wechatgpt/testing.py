@@ -0,0 +1,67 @@
+"""Helpers shared by the tests."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from .bot import Bot
+
+
+class StandInProxy:
+    """A local http proxy stand-in, which answers every request itself after `delay` seconds, or with 502 if `failing`."""
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.failing = False
+        self.finish_reason = "stop"
+        self.request_count = 0
+        self.last_request: Optional[dict] = None
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self):
+                stand_in.request_count += 1
+                time.sleep(stand_in.delay)
+                if stand_in.failing:
+                    self.send_response(502)
+                    self.end_headers()
+                    return
+                body = json.dumps(
+                    {"usage": {"total_tokens": 10, "completion_tokens": 5}, "choices": [{"message": {"content": "hi"}, "finish_reason": stand_in.finish_reason}]}
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._answer()
+
+            def do_POST(self):
+                stand_in.last_request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "null")
+                self._answer()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SlowMockBot(Bot):
+    """Answers every question after 0.3s, and keeps the questions asked."""
+
+    def __init__(self) -> None:
+        self.questions: List[str] = []
+
+    def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+        self.questions.append(question)
+        time.sleep(0.3)
+        return f"answer to {question}"
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import traceback
+from collections import Counter, deque
+from typing import Deque, List, Optional, Tuple
+
+from .logger import get_logger
+
+
+class Trace:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = time.perf_counter()
+        # (name, depth, duration), duration is filled when the span is closed
+        self.spans: List[List] = []
+        self.depth = 0
+
+    def open_span(self, name: str) -> int:
+        self.spans.append([name, self.depth, 0.0])
+        self.depth += 1
+        return len(self.spans) - 1
+
+    def close_span(self, index: int, duration: float):
+        self.spans[index][2] = duration
+        self.depth -= 1
+
+    def summary(self) -> str:
+        total_ms = (time.perf_counter() - self.started_at) * 1000
+        spans = " ".join(f"{'>' * depth}{name}={duration * 1000:.1f}ms" for name, depth, duration in self.spans)
+        return f"{self.name}={total_ms:.1f}ms {spans}"
+
+
+class _Span:
+    __slots__ = ("trace", "name", "index", "started_at")
+
+    def __init__(self, trace: Trace, name: str) -> None:
+        self.trace, self.name = trace, name
+
+    def __enter__(self):
+        self.index = self.trace.open_span(self.name)
+        self.started_at = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.trace.close_span(self.index, time.perf_counter() - self.started_at)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """Per-request trace spans, recorded only while enabled. When disabled, `span` costs a thread local lookup."""
+
+    def __init__(self, max_recent_traces: int = 100) -> None:
+        self.enabled_until = 0.0
+        self.local = threading.local()
+        self.recent_traces: Deque[str] = deque(maxlen=max_recent_traces)
+
+    def enable(self, seconds: float):
+        self.enabled_until = time.time() + seconds
+
+    def start_trace(self, name: str):
+        self.local.trace = Trace(name) if time.time() < self.enabled_until else None
+
+    def span(self, name: str):
+        trace = getattr(self.local, "trace", None)
+        return _Span(trace, name) if trace is not None else _NOOP_SPAN
+
+    def finish_trace(self):
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            return
+        self.local.trace = None
+        summary = trace.summary()
+        self.recent_traces.append(summary)
+        get_logger().info(f"trace: {summary}")
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads, and counts them in the collapsed format used by flame graph tools."""
+
+    def __init__(self, interval_seconds: float = 0.005) -> None:
+        self.interval_seconds = interval_seconds
+        self.stacks: Counter = Counter()
+        self.sample_count = 0
+
+    def run(self, seconds: float):
+        current_thread_id = threading.get_ident()
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == current_thread_id:
+                    continue
+                stack = [f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{f.f_code.co_firstlineno})" for f, _ in traceback.walk_stack(frame)]
+                self.stacks[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+            time.sleep(self.interval_seconds)
+
+    def top_functions(self, limit: int = 10) -> List[Tuple[str, int]]:
+        """Functions on top of the sampled stacks, i.e. where the time was spent."""
+        self_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack.rsplit(";", 1)[-1]] += count
+        return self_counts.most_common(limit)
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Diagnostics:
+    """Runs one profiling session at a time in the background, started by admin commands."""
+
+    MAX_SECONDS = 300
+
+    def __init__(self, tracer: Tracer, output_dir: Optional[str] = None) -> None:
+        self.tracer = tracer
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.lock = threading.Lock()
+        self.running: Optional[str] = None
+        self.last_result = "no profiling result yet."
+
+    def _start(self, name: str, seconds: int, session) -> str:
+        with self.lock:
+            if self.running:
+                return f"{self.running} is running, please wait for it to finish."
+            self.running = name
+        path = os.path.join(self.output_dir, f"wechatgpt-{name}-{time.strftime('%Y%m%d_%H%M%S')}.txt")
+
+        def run():
+            try:
+                self.last_result = session(seconds, path)
+            except Exception:
+                get_logger().error(f"{name} failed: ", exc_info=True)
+                self.last_result = f"{name} failed, see logs."
+            finally:
+                self.running = None
+            get_logger().info(f"{name} finished: {self.last_result}")
+
+        threading.Thread(target=run, daemon=True).start()
+        return f"{name} started for {seconds}s, result will be written to {path}"
+
+    def _profile(self, seconds: int, path: str) -> str:
+        profiler = SamplingProfiler()
+        profiler.run(seconds)
+        profiler.dump(path)
+        top = "\n".join(f"{count} {func}" for func, count in profiler.top_functions())
+        return f"profile ({profiler.sample_count} samples) written to {path}, top functions:\n{top}"
+
+    def _tracemalloc(self, seconds: int, path: str) -> str:
+        tracemalloc.start()
+        try:
+            time.sleep(seconds)
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+        finally:
+            tracemalloc.stop()
+        with open(path, "w") as f:
+            f.write("\n".join(str(s) for s in stats))
+        top = "\n".join(str(s) for s in stats[:10])
+        return f"tracemalloc snapshot written to {path}, top allocations:\n{top}"
+
+    def start_profile(self, seconds: int) -> str:
+        return self._start("profile", seconds, self._profile)
+
+    def start_tracemalloc(self, seconds: int) -> str:
+        return self._start("tracemalloc", seconds, self._tracemalloc)
+
+    def start_trace(self, seconds: int) -> str:
+        self.tracer.enable(seconds)
+        return f"trace enabled for {seconds}s, use get_diagnostics to see recent traces."
+
+    def summary(self) -> str:
+        traces = "\n".join(list(self.tracer.recent_traces)[-10:]) or "no trace yet."
+        return f"recent traces:\n{traces}\n\n{self.last_result}"
+
+
+tracer = Tracer()
+diagnostics = Diagnostics(tracer)
+
+
+def get_tracer() -> Tracer:
+    return tracer
+
+
+def get_diagnostics() -> Diagnostics:
+    return diagnostics
@@ -0,0 +1,66 @@
+import tempfile
+import threading
+import time
+import unittest
+
+from .tracing import _NOOP_SPAN, Diagnostics, SamplingProfiler, Tracer
+from .usage_policy import CommandFormatError, UsagePolicy
+
+
+class TracerTest(unittest.TestCase):
+    def test_noop_when_disabled(self):
+        tracer = Tracer()
+        tracer.start_trace("/wechat")
+        self.assertIs(tracer.span("handle"), _NOOP_SPAN)
+        with tracer.span("handle"):
+            pass
+        tracer.finish_trace()
+        self.assertEqual(len(tracer.recent_traces), 0)
+
+    def test_trace_spans(self):
+        tracer = Tracer()
+        tracer.enable(10)
+        tracer.start_trace("/wechat")
+        with tracer.span("handle"):
+            with tracer.span("upstream"):
+                time.sleep(0.01)
+        with tracer.span("reply"):
+            pass
+        tracer.finish_trace()
+        summary = tracer.recent_traces[-1]
+        self.assertRegex(summary, r"^/wechat=[\d.]+ms handle=[\d.]+ms >upstream=[\d.]+ms reply=[\d.]+ms$")
+        # spans outside a trace are ignored
+        self.assertIs(tracer.span("handle"), _NOOP_SPAN)
+
+
+class SamplingProfilerTest(unittest.TestCase):
+    def test_profile(self):
+        def busy_function():
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy_function)
+        thread.start()
+        profiler = SamplingProfiler(interval_seconds=0.001)
+        profiler.run(0.2)
+        thread.join()
+        self.assertGreater(profiler.sample_count, 10)
+        self.assertTrue(any("busy_function" in stack for stack in profiler.stacks))
+
+
+class DiagnosticsCommandTest(unittest.TestCase):
+    def test_commands(self):
+        up = UsagePolicy(["a"], token="c")
+        self.assertRaises(CommandFormatError, lambda: up.handle_usage_change_command("a", "admin-command:c\nprofile\n0", {}))
+        self.assertRaises(CommandFormatError, lambda: up.handle_usage_change_command("a", "admin-command:c\nprofile\nabc", {}))
+        msg = up.handle_usage_change_command("a", "admin-command:c\ntrace\n10", {})
+        self.assertIn("trace enabled", msg)  # type: ignore
+
+        with tempfile.TemporaryDirectory() as folder:
+            diagnostics = Diagnostics(Tracer(), folder)
+            self.assertIn("started", diagnostics.start_tracemalloc(1))
+            self.assertIn("is running", diagnostics.start_profile(1))
+            time.sleep(1.5)
+            self.assertIn("top allocations", diagnostics.summary())
+            self.assertIsNone(diagnostics.running)
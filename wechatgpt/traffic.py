@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+from threading import Lock
+from typing import Callable, Iterator, Optional
+
+
+def hash_user_id(user: str) -> str:
+    md5 = hashlib.md5()
+    md5.update(user.encode())
+    return md5.hexdigest()
+
+
+# CJK extension A, rare characters which are still word characters, so that placeholders look like text to the
+# prefilter and the semantic cache without matching any blocked word or canned message
+_PLACEHOLDER_FIRST, _PLACEHOLDER_COUNT = 0x3400, 6582
+
+
+def redact_text(text: str, key: bytes) -> str:
+    """Replaces a text by a placeholder of the same length derived from a keyed hash, equal texts get equal placeholders."""
+    digest = b""
+    while len(digest) < 2 * len(text):
+        digest += hmac.new(key, f"{len(digest)}:{text}".encode(), hashlib.sha256).digest()
+    return "".join(chr(_PLACEHOLDER_FIRST + int.from_bytes(digest[2 * i : 2 * i + 2], "big") % _PLACEHOLDER_COUNT) for i in range(len(text)))
+
+
+def _xml_value(xml: str, name: str) -> Optional[str]:
+    found = re.search(rf"<{name}>\s*(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))\s*</{name}>", xml, re.S)
+    return (found.group(1) if found.group(1) is not None else found.group(2)) if found else None
+
+
+class TrafficRecorder:
+    """Writes anonymized inbound messages and upstream call outcomes as timestamped json lines.
+
+    User ids are hashed the same way as the id sent to OpenAI, query args (signatures, openid) are not kept, and unless
+    `redact_content` is turned off, message texts are replaced by placeholders of the same length keyed by
+    `redaction_key`, so that retries and repeated questions still look the same on replay. "1" and other commands
+    answered by the server itself (e.g. for the next page) are kept as is.
+    """
+
+    def __init__(self, path: str, redact_content: bool = True, redaction_key: Optional[str] = None) -> None:
+        self.path = path
+        self.redact_content = redact_content
+        # without a key, placeholders only stay the same within this process
+        self.redaction_key = redaction_key.encode() if redaction_key else os.urandom(32)
+        self.lock = Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _write(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def record_request(self, method: str, body: str, is_command: Optional[Callable[[str], bool]] = None):
+        """`is_command` tells messages handled without the bot, which are kept in the capture as they are."""
+        if method != "POST":
+            return
+        user = _xml_value(body, "FromUserName")
+        text = _xml_value(body, "Content")
+        if text is not None and self.redact_content and text != "1" and not (is_command and is_command(text)):
+            text = redact_text(text, self.redaction_key)
+        self._write(
+            {
+                "t": time.time(),
+                "kind": "request",
+                "user": hash_user_id(user) if user else None,
+                "msg_type": _xml_value(body, "MsgType"),
+                "text": text,
+            }
+        )
+
+    def record_upstream(self, user: str, latency_seconds: float, status_code: Optional[int], completion_tokens: int = 0):
+        """Records an upstream call, `status_code` None means the call failed without a response."""
+        self._write(
+            {
+                "t": time.time(),
+                "kind": "upstream",
+                "user": hash_user_id(user),
+                "latency": round(latency_seconds, 4),
+                "status": status_code,
+                "completion_tokens": completion_tokens,
+            }
+        )
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_events(path: str) -> Iterator[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
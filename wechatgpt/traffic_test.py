@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+
+from .replay import replay
+from .traffic import TrafficRecorder, hash_user_id, read_events, redact_text
+
+
+def request_xml(user: str, text: str) -> str:
+    return (
+        f"<xml><ToUserName><![CDATA[account]]></ToUserName><FromUserName><![CDATA[{user}]]></FromUserName>"
+        f"<CreateTime>1</CreateTime><MsgType><![CDATA[text]]></MsgType><Content><![CDATA[{text}]]></Content></xml>"
+    )
+
+
+class TrafficRecorderTest(unittest.TestCase):
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "capture.jsonl")
+            recorder = TrafficRecorder(path)
+            recorder.record_request("GET", "")
+            recorder.record_request("POST", request_xml("alice", "你好呀"))
+            recorder.record_request("POST", request_xml("alice", "1"))
+            recorder.record_request("POST", request_xml("alice", "你好呀"))
+            recorder.record_request("POST", request_xml("alice", "谢谢你"))
+            recorder.record_request("POST", request_xml("alice", "更多"), is_command=lambda text: text == "更多")
+            recorder.record_upstream("alice", 1.23456, 200, 42)
+            recorder.record_upstream("alice", 0.5, None)
+            recorder.close()
+            events = list(read_events(path))
+            with open(path, encoding="utf-8") as f:
+                content = f.read()
+                self.assertNotIn("alice", content)
+                self.assertNotIn("你好呀", content)
+
+        self.assertEqual([e["kind"] for e in events], ["request"] * 5 + ["upstream"] * 2)
+        self.assertEqual(events[0]["user"], hash_user_id("alice"))
+        texts = [e["text"] for e in events[:5]]
+        # a wechat retry still looks like one, a different message of the same length doesn't
+        self.assertEqual(len(texts[0]), 3)
+        self.assertEqual(texts[2], texts[0])
+        self.assertNotEqual(texts[3], texts[0])
+        self.assertEqual([texts[1], texts[4]], ["1", "更多"])
+        self.assertEqual(events[5]["latency"], 1.2346)
+        self.assertEqual((events[5]["status"], events[5]["completion_tokens"]), (200, 42))
+        self.assertIsNone(events[6]["status"])
+
+    def test_redact_text(self):
+        self.assertEqual(redact_text("你好", b"key"), redact_text("你好", b"key"))
+        self.assertNotEqual(redact_text("你好", b"key"), redact_text("你好", b"other key"))
+        self.assertEqual(len(redact_text("x" * 100, b"key")), 100)
+
+
+class ReplayTest(unittest.TestCase):
+    def test_replay(self):
+        events = [
+            {"t": 100.0, "kind": "request", "user": "u1", "msg_type": "text", "text": "question one"},
+            {"t": 100.5, "kind": "request", "user": "u2", "msg_type": "text", "text": "question two"},
+            {"t": 101.0, "kind": "upstream", "user": "u1", "latency": 2.0, "status": 200, "completion_tokens": 3},
+            {"t": 101.5, "kind": "upstream", "user": "u2", "latency": 1.0, "status": 500, "completion_tokens": 0},
+            {"t": 104.0, "kind": "request", "user": "u1", "msg_type": "text", "text": "question three"},
+            {"t": 105.0, "kind": "upstream", "user": "u1", "latency": 1.0, "status": None, "completion_tokens": 0},
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "capture.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(json.dumps(e) for e in events))
+            # the files of a live server are left alone
+            live_paths = {name: os.path.join(folder, name) for name in ["ledger", "retry.db", "snapshot.json", "live-capture.jsonl"]}
+            environ = {
+                "ledger_dir": live_paths["ledger"],
+                "retry_queue_path": live_paths["retry.db"],
+                "snapshot_path": live_paths["snapshot.json"],
+                "traffic_capture_path": live_paths["live-capture.jsonl"],
+            }
+            result = replay(path, speed=20, environ=environ)
+            self.assertFalse([p for p in live_paths.values() if os.path.exists(p)])
+
+        self.assertEqual(len(result["latencies"]), 3)
+        self.assertEqual(result["upstream_calls"], 3)
+        self.assertEqual(result["replies"]["replayed answer"], 1)
+        # failed answers are queued for retry, as configured
+        self.assertEqual(result["replies"]["抱歉，助手暂时无法回答，已为您在后台重试，请稍后回复“1”查看回复。"], 2)
+        self.assertLess(result["elapsed"], 2)
@@ -3,11 +3,15 @@ from __future__ import annotations
 import json
 import re
 import time
-from datetime import datetime
-from threading import Thread
-from typing import Callable, Dict, List, Optional, Set, Union
+from collections import deque
+from datetime import date, datetime, timedelta
+from threading import Lock, Thread
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Union
 
+from .ledger import TokenLedger
 from .logger import get_logger
+from .metrics import get_metrics
+from .tracing import Diagnostics, get_diagnostics
 
 
 class UserChatStat:
@@ -19,14 +23,22 @@ class UserChatStat:
         self.user = user
         self.chat_count = 0
         self.total_chat_count = 0
+        self.today_chat_count = 0
         self.last_chat_at: Optional[datetime] = None
         default_current_date = lambda: datetime.now()
         self.current_date = current_date or default_current_date
 
+    def chat_count_on(self, day: datetime) -> int:
+        if self.last_chat_at is None or self.last_chat_at.date() != day.date():
+            return 0
+        return self.today_chat_count
+
     def on_chat(self):
+        now = self.current_date()
+        self.today_chat_count = self.chat_count_on(now) + 1
         self.chat_count += 1
         self.total_chat_count += 1
-        self.last_chat_at = self.current_date()
+        self.last_chat_at = now
 
     def under_limit(self, limit: int):
         return self.chat_count < limit
@@ -35,6 +47,59 @@ class UserChatStat:
         self.chat_count = 0
         self.last_chat_at = None
 
+    def to_snapshot(self) -> list:
+        return [self.chat_count, self.total_chat_count, self.today_chat_count, self.last_chat_at.timestamp() if self.last_chat_at else None]
+
+    def load_snapshot(self, data: list):
+        self.chat_count, self.total_chat_count, self.today_chat_count, last_chat_at = data
+        self.last_chat_at = datetime.fromtimestamp(last_chat_at) if last_chat_at is not None else None
+
+
+class UserTier:
+    ADMIN = "admin"
+    WHITE_LIST = "white_list"
+    DEFAULT = "default"
+
+
+class ChatCountAggregate:
+    """Running sum/max/min of per-user chat counts, maintained in O(1) per chat."""
+
+    def __init__(self) -> None:
+        self.user_count = 0
+        self.chat_count = 0
+        self.max_user_chat_count = 0
+        self.min_user_chat_count = 0
+        # number of users for each chat count, used to move the min forward when its last user chats again
+        self.users_by_chat_count: Dict[int, int] = {}
+
+    def on_chat(self, previous_user_chat_count: int):
+        count = previous_user_chat_count + 1
+        self.chat_count += 1
+        if previous_user_chat_count == 0:
+            self.user_count += 1
+        else:
+            self.users_by_chat_count[previous_user_chat_count] -= 1
+            if self.users_by_chat_count[previous_user_chat_count] == 0:
+                del self.users_by_chat_count[previous_user_chat_count]
+        self.users_by_chat_count[count] = self.users_by_chat_count.get(count, 0) + 1
+        self.max_user_chat_count = max(self.max_user_chat_count, count)
+        if previous_user_chat_count == 0:
+            self.min_user_chat_count = 1
+        elif previous_user_chat_count == self.min_user_chat_count and previous_user_chat_count not in self.users_by_chat_count:
+            self.min_user_chat_count = count
+
+    def avg_user_chat_count(self) -> float:
+        return self.chat_count / self.user_count if self.user_count else 0
+
+    def to_snapshot(self) -> dict:
+        return {**vars(self), "users_by_chat_count": list(self.users_by_chat_count.items())}
+
+    @staticmethod
+    def from_snapshot(data: dict) -> ChatCountAggregate:
+        aggregate = ChatCountAggregate()
+        aggregate.__dict__.update({**data, "users_by_chat_count": dict(data["users_by_chat_count"])})
+        return aggregate
+
 
 class CommandFormatError(Exception):
     def __init__(self, *args: object) -> None:
@@ -50,6 +115,9 @@ class UsagePolicy:
         default_user_chat_count_per_day: int = 20,
         token: Optional[str] = None,
         current_date: Optional[Callable[[], datetime]] = None,
+        hourly_stat_hours: int = 48,
+        ledger: Optional[TokenLedger] = None,
+        default_user_tokens_per_day: Optional[int] = None,
     ) -> None:
         self.admin_users = admin_users
         self.user_chat_stat: Dict[str, UserChatStat] = {}
@@ -61,6 +129,14 @@ class UsagePolicy:
         self.token = token
         default_current_date = lambda: datetime.now()
         self.current_date = current_date or default_current_date
+        self.stat_lock = Lock()
+        self.total_stat = ChatCountAggregate()
+        self.today_stat = ChatCountAggregate()
+        self.today_stat_day = self.current_date().date()
+        self.hourly_chat_count: Deque[Tuple[datetime, int]] = deque(maxlen=hourly_stat_hours or None)
+        self.hourly_stat_hours = hourly_stat_hours
+        self.ledger = ledger
+        self.default_user_tokens_per_day = default_user_tokens_per_day
         self.saving_list_thread = Thread(target=self.save_config, daemon=True)
         self.saving_list_thread.start()
 
@@ -86,24 +162,77 @@ class UsagePolicy:
                 print("save config error!")
                 traceback.print_exc()
 
+    def to_snapshot(self) -> dict:
+        with self.stat_lock:
+            return {
+                "user_chat_count_per_day": dict(self.user_chat_count_per_day),
+                "user_chat_stat": {user: stat.to_snapshot() for user, stat in list(self.user_chat_stat.items())},
+                "total_stat": self.total_stat.to_snapshot(),
+                "today_stat": self.today_stat.to_snapshot(),
+                "today_stat_day": self.today_stat_day.isoformat(),
+                "hourly_chat_count": [[hour.timestamp(), count] for hour, count in self.hourly_chat_count],
+            }
+
+    def load_snapshot(self, data: dict):
+        """Restores chat stats and per user limits. Admin and white list users always come from the current config."""
+        user_chat_stat = {}
+        for user, stat_data in data["user_chat_stat"].items():
+            user_chat_stat[user] = UserChatStat(user, current_date=self.current_date)
+            user_chat_stat[user].load_snapshot(stat_data)
+        with self.stat_lock:
+            self.user_chat_stat = user_chat_stat
+            self.user_chat_count_per_day.update(data["user_chat_count_per_day"])
+            self.total_stat = ChatCountAggregate.from_snapshot(data["total_stat"])
+            self.today_stat = ChatCountAggregate.from_snapshot(data["today_stat"])
+            self.today_stat_day = date.fromisoformat(data["today_stat_day"])
+            self.hourly_chat_count.clear()
+            self.hourly_chat_count.extend((datetime.fromtimestamp(hour), count) for hour, count in data["hourly_chat_count"])
+            self._rollover_today_stat(self.current_date())
+
+    def _rollover_today_stat(self, now: datetime):
+        if now.date() != self.today_stat_day:
+            self.today_stat = ChatCountAggregate()
+            self.today_stat_day = now.date()
+
+    def _count_hourly_chat(self, now: datetime):
+        if not self.hourly_stat_hours:
+            return
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        if self.hourly_chat_count and self.hourly_chat_count[-1][0] == hour:
+            self.hourly_chat_count[-1] = (hour, self.hourly_chat_count[-1][1] + 1)
+        else:
+            self.hourly_chat_count.append((hour, 1))
+
     def get_stat(self, chatting_users: Dict[str, bool]) -> dict:
-        user_total_chat_count = [u.total_chat_count for u in self.user_chat_stat.values()]
-        now = datetime.now()
-        today = datetime(now.year, now.month, now.day)
-        today_user_chat_count = [u.chat_count for u in self.user_chat_stat.values() if u.last_chat_at and u.last_chat_at >= today]
-        return {
-            "total_user_count": len(self.user_chat_stat),
-            "total_chat_count": sum(user_total_chat_count),
-            "max_user_chat_count": max(user_total_chat_count) if len(user_total_chat_count) else 0,
-            "min_user_chat_count": min(user_total_chat_count) if len(user_total_chat_count) else 0,
-            "avg_user_chat_count": sum(user_total_chat_count) / len(self.user_chat_stat) if len(user_total_chat_count) else 0,
-            "today_chat_user_count": len(today_user_chat_count),
-            "today_chat_count": sum(today_user_chat_count),
-            "today_max_user_chat_count": max(today_user_chat_count) if len(today_user_chat_count) else 0,
-            "today_min_user_chat_count": min(today_user_chat_count) if len(today_user_chat_count) else 0,
-            "today_avg_user_chat_count": sum(today_user_chat_count) / len(today_user_chat_count) if len(today_user_chat_count) else 0,
-            "chatting_user_count": len(chatting_users),
-        }
+        with self.stat_lock:
+            self._rollover_today_stat(self.current_date())
+            total_stat, today_stat = self.total_stat, self.today_stat
+            return {
+                "total_user_count": len(self.user_chat_stat),
+                "total_chat_count": total_stat.chat_count,
+                "max_user_chat_count": total_stat.max_user_chat_count,
+                "min_user_chat_count": total_stat.min_user_chat_count,
+                "avg_user_chat_count": total_stat.avg_user_chat_count(),
+                "today_chat_user_count": today_stat.user_count,
+                "today_chat_count": today_stat.chat_count,
+                "today_max_user_chat_count": today_stat.max_user_chat_count,
+                "today_min_user_chat_count": today_stat.min_user_chat_count,
+                "today_avg_user_chat_count": today_stat.avg_user_chat_count(),
+                "chatting_user_count": len(chatting_users),
+                **(self.ledger.stat() if self.ledger else {}),
+            }
+
+    def get_hourly_stat(self) -> List[Tuple[datetime, int]]:
+        """Chat count per hour for the most recent `hourly_stat_hours` hours, hours without chats are filled with 0."""
+        with self.stat_lock:
+            hourly_chat_count = list(self.hourly_chat_count)
+        if not hourly_chat_count:
+            return []
+        counts = dict(hourly_chat_count)
+        now_hour = self.current_date().replace(minute=0, second=0, microsecond=0)
+        first_hour = max(hourly_chat_count[0][0], now_hour - timedelta(hours=self.hourly_stat_hours - 1))
+        hours = int((now_hour - first_hour).total_seconds() // 3600) + 1
+        return [(first_hour + timedelta(hours=i), counts.get(first_hour + timedelta(hours=i), 0)) for i in range(hours)]
 
     def handle_usage_change_command(self, user: str, msg: str, chatting_users: Dict[str, bool]) -> Union[bool, str]:
         lines = [line.strip() for line in msg.split("\n") if line.strip()]
@@ -139,6 +268,27 @@ class UsagePolicy:
                 return self.dict_to_msg(self.as_dict())
             elif cmd == "get_stat":
                 return self.dict_to_msg(self.get_stat(chatting_users))
+            elif cmd == "get_hourly_stat":
+                return self.dict_to_msg({hour.strftime("%Y-%m-%d %H:00"): count for hour, count in self.get_hourly_stat()})
+            elif cmd == "get_token_stat":
+                by = lines[2].strip()
+                if self.ledger is None:
+                    raise CommandFormatError("Token ledger is not enabled")
+                if by not in ("user", "day", "model"):
+                    raise CommandFormatError(f"Args for get_token_stat must be one of user, day, model, found {lines[2]}")
+                rows = self.ledger.aggregate(by, limit=20)
+                return "\n".join(f"{key}: calls={calls}, prompt_tokens={prompt}, completion_tokens={completion}" for key, calls, prompt, completion in rows)
+            elif cmd == "get_metrics":
+                return self.dict_to_msg(get_metrics().snapshot())
+            elif cmd in ("trace", "profile", "tracemalloc"):
+                seconds = lines[2].strip()
+                if not re.match(r"^[\d]+$", seconds) or not 0 < int(seconds) <= Diagnostics.MAX_SECONDS:
+                    raise CommandFormatError(f"Args for {cmd} must be seconds in (0, {Diagnostics.MAX_SECONDS}], found {lines[2]}")
+                diagnostics = get_diagnostics()
+                start = {"trace": diagnostics.start_trace, "profile": diagnostics.start_profile, "tracemalloc": diagnostics.start_tracemalloc}[cmd]
+                return start(int(seconds))
+            elif cmd == "get_diagnostics":
+                return get_diagnostics().summary()
             else:
                 raise CommandFormatError("Unknown command: " + cmd)
             return True
@@ -159,17 +309,34 @@ class UsagePolicy:
         get_logger().info(f"set user chat count per day from {self.user_chat_count_per_day.get(user, None)} to {limit}")
         self.user_chat_count_per_day[user] = limit
 
+    def user_tier(self, user: str) -> str:
+        if user in self.admin_users:
+            return UserTier.ADMIN
+        if user in self.user_white_list:
+            return UserTier.WHITE_LIST
+        return UserTier.DEFAULT
+
     def on_chat(self, user: str):
         if user not in self.user_chat_stat:
             self.user_chat_stat[user] = UserChatStat(user, current_date=self.current_date)
         chat_stat = self.user_chat_stat[user]
-        chat_stat.on_chat()
+        with self.stat_lock:
+            now = self.current_date()
+            self._rollover_today_stat(now)
+            self.total_stat.on_chat(chat_stat.total_chat_count)
+            self.today_stat.on_chat(chat_stat.chat_count_on(now))
+            self._count_hourly_chat(now)
+            chat_stat.on_chat()
 
     def reached_limit(self, user: str) -> bool:
         if user not in self.user_chat_stat:
             return False
         if user in self.user_white_list:
             return False
+        # users with their own chat limit are not limited by tokens
+        if self.ledger and self.default_user_tokens_per_day and user not in self.user_chat_count_per_day:
+            if self.ledger.user_tokens_today(user) >= self.default_user_tokens_per_day:
+                return True
         chat_stat = self.user_chat_stat[user]
         if chat_stat.last_chat_at and self.current_date().day != chat_stat.last_chat_at.day:
             chat_stat.reset_stat()
@@ -42,3 +42,61 @@ class UsagePolicyTest(unittest.TestCase):
 
         self.assertTrue(up.handle_usage_change_command("a", "admin-command:c\nset_limit\nd,10", {}))
         self.assertEqual(up.user_chat_count_per_day["d"], 10)
+
+    def test_stat(self):
+        return_date = datetime(2023, 1, 1, 10, 10, 10)
+
+        def current_date():
+            return return_date
+
+        up = UsagePolicy(["a"], current_date=current_date, token="c")
+        for user in ["b", "b", "b", "c", "d", "d"]:
+            up.on_chat(user)
+        stat = up.get_stat({"b": True})
+        self.assertEqual(stat["total_user_count"], 3)
+        self.assertEqual(stat["total_chat_count"], 6)
+        self.assertEqual(stat["max_user_chat_count"], 3)
+        self.assertEqual(stat["min_user_chat_count"], 1)
+        self.assertEqual(stat["avg_user_chat_count"], 2)
+        self.assertEqual(stat["today_chat_user_count"], 3)
+        self.assertEqual(stat["chatting_user_count"], 1)
+
+        up.on_chat("c")
+        self.assertEqual(up.get_stat({})["min_user_chat_count"], 2)
+
+        return_date = datetime(2023, 1, 2, 1, 0, 0)
+        stat = up.get_stat({})
+        self.assertEqual(stat["total_chat_count"], 7)
+        self.assertEqual(stat["today_chat_user_count"], 0)
+        self.assertEqual(stat["today_chat_count"], 0)
+
+        up.on_chat("c")
+        up.on_chat("c")
+        up.on_chat("e")
+        stat = up.get_stat({})
+        self.assertEqual(stat["total_user_count"], 4)
+        self.assertEqual(stat["max_user_chat_count"], 4)
+        self.assertEqual(stat["min_user_chat_count"], 1)
+        self.assertEqual(stat["today_chat_user_count"], 2)
+        self.assertEqual(stat["today_chat_count"], 3)
+        self.assertEqual(stat["today_max_user_chat_count"], 2)
+        self.assertEqual(stat["today_min_user_chat_count"], 1)
+
+    def test_hourly_stat(self):
+        return_date = datetime(2023, 1, 1, 10, 10, 10)
+
+        def current_date():
+            return return_date
+
+        up = UsagePolicy(["a"], current_date=current_date, token="c", hourly_stat_hours=3)
+        up.on_chat("b")
+        up.on_chat("c")
+        return_date = datetime(2023, 1, 1, 12, 0, 0)
+        up.on_chat("b")
+        self.assertEqual(
+            up.get_hourly_stat(),
+            [(datetime(2023, 1, 1, 10), 2), (datetime(2023, 1, 1, 11), 0), (datetime(2023, 1, 1, 12), 1)],
+        )
+        return_date = datetime(2023, 1, 1, 13, 0, 0)
+        self.assertEqual(up.get_hourly_stat()[0], (datetime(2023, 1, 1, 11), 0))
+        self.assertTrue(up.handle_usage_change_command("a", "admin-command:c\nget_hourly_stat\n-", {}).startswith("2023-01-01 11:00: 0"))
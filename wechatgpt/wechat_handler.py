@@ -3,14 +3,20 @@ import hashlib
 
 import random
 import time
-from typing import Callable, Optional, Dict, Union
+from threading import Condition, Lock
+from typing import Callable, List, Optional, Dict, Set, Tuple, Union
 from urllib import parse
 
 from wechatgpt.usage_policy import CommandFormatError, UsagePolicy
 from wechatgpt.wechat_msg import TextMessageContent, WechatMsg
 
-from .bot import Bot
+from .bot import Bot, BusyError
 from .logger import get_logger
+from .pagination import AnswerPager
+from .prefilter import MessagePrefilter
+from .request_context import start_request
+from .retry_queue import RetryQueue
+from .tracing import get_tracer
 
 
 class Response:
@@ -48,13 +54,52 @@ class Request:
 
 
 class WechatMsgHandler:
-    def __init__(self, bot: Bot, usage_policy: UsagePolicy, admin_email: str):
+    def __init__(
+        self,
+        bot: Bot,
+        usage_policy: UsagePolicy,
+        admin_email: str,
+        merge_window_ms: int = 0,
+        max_merged_msgs: int = 5,
+        prefilter: Optional[MessagePrefilter] = None,
+        pager: Optional[AnswerPager] = None,
+        retry_queue: Optional[RetryQueue] = None,
+        retryable_answers: Optional[Set[str]] = None,
+    ):
         self.bot = bot
         self.usage_policy = usage_policy
         self.admin_email = admin_email
+        self.prefilter = prefilter
+        self.pager = pager or AnswerPager()
+        # questions answered with one of `retryable_answers` (e.g. the bot's error reply) or failed are retried later
+        self.retry_queue = retry_queue
+        self.retryable_answers = retryable_answers or set()
         self.chating_users: Dict[str, bool] = {}
-        self.chating_user_asks: Dict[str, str] = {}
+        # all questions asked in the current chat, used to tell wechat retries from new messages
+        self.chating_user_asks: Dict[str, List[str]] = {}
+        # questions not sent to the bot yet, they will be merged into the next upstream call
+        self.chating_user_pending_asks: Dict[str, List[str]] = {}
+        # users whose question is being answered, messages arriving now are not merged into it
+        self.chating_user_dispatched: Set[str] = set()
+        # messages arrived while the bot was answering, they are answered together in the next turn of the chat
+        self.chating_user_next_asks: Dict[str, List[str]] = {}
+        # users whose first message of the next turn is still waiting to answer it, otherwise the chat's thread does
+        self.chating_user_next_turn_waiting: Set[str] = set()
+        # how long the first message of the next turn waits for the answer in flight, within wechat's reply window
+        self.next_turn_wait_seconds = 3.0
         self.chating_user_answers: Dict[str, WechatMsg] = {}
+        # busy or restarting replies are kept apart from answers, so that "1" still gives the last real answer
+        self.chating_user_unanswered_replies: Dict[str, WechatMsg] = {}
+        self.chat_lock = Lock()
+        # notified when a turn of a chat is over and the next one may start
+        self.chat_turn_ended = Condition(self.chat_lock)
+        # wait this long for more messages before asking the bot, so that a question typed as several messages is answered at once
+        self.merge_window_seconds = merge_window_ms / 1000.0
+        self.max_merged_msgs = max_merged_msgs
+        # set before a restart, new questions are not sent to the bot any more
+        self.draining = False
+        # files kept in memory until flushed (ledger, semantic cache, state snapshot), written after draining
+        self.drain_flushes: List[Callable[[], Optional[dict]]] = []
 
         def create_response_msg_creator(predefined_msg: Union[str, Callable[[WechatMsg], str]]) -> Callable[[WechatMsg], WechatMsg]:
             def response_msg_creator(request_msg: WechatMsg) -> WechatMsg:
@@ -66,6 +111,9 @@ class WechatMsgHandler:
         self.wait_timeout_msg_creator = create_response_msg_creator("这个问题有点难，助手还在思考中...\n\n回复“1”查看回复。")
         self.ask_too_fast_msg_creator = create_response_msg_creator("抱歉，您的回复太快啦，助手还在思考前一个问题呢！\n\n回复“1”查看前一个问题的回复。")
         self.system_error_msg_creator = create_response_msg_creator("抱歉，系统错误，请稍候再试！")
+        self.restarting_msg_creator = create_response_msg_creator("抱歉，服务正在升级重启，请稍候再试！")
+        self.retry_queued_msg = "抱歉，助手暂时无法回答，已为您在后台重试，请稍后回复“1”查看回复。"
+        self.retry_pending_msg_creator = create_response_msg_creator("助手还在后台重试您的问题，请稍后回复“1”查看回复。")
         self.rate_limit_msg_creator = create_response_msg_creator(
             lambda request_msg: f"抱歉，您今日的聊天次数已达上限，请明日再来！\n\n如希望解除限制，请发送您的ID({request_msg.from_user_name})至邮箱 {self.admin_email} ，并附上一个充分的理由。",
         )
@@ -104,8 +152,10 @@ class WechatMsgHandler:
         return self.as_response("")
 
     def handle(self, request) -> Response:
+        start_request()
         try:
-            request_msg = WechatMsg.from_raw_xml(request.body)
+            with get_tracer().span("parse"):
+                request_msg = WechatMsg.from_raw_xml(request.body)
         except Exception as e:
             get_logger().info(f"unable to parse message, will ignore it: {e.args}")
             return self.empty_response()
@@ -114,14 +164,25 @@ class WechatMsgHandler:
             get_logger().info("found unknown message, will ignore it.")
             return self.empty_response()
 
-        resp = self.handle_command(request_msg)
+        with get_tracer().span("command"):
+            resp = self.handle_command(request_msg)
+        if resp:
+            return resp
+
+        resp = self.handle_for_next_page(request_msg)
         if resp:
             return resp
 
         if self.usage_policy.reached_limit(request_msg.from_user_name):
             return self.as_response(self.rate_limit_msg_creator(request_msg))
 
-        resp = self.handle_for_waiting_chat(request_msg)
+        with get_tracer().span("prefilter"):
+            resp = self.handle_for_prefiltered_msg(request_msg)
+        if resp:
+            return resp
+
+        with get_tracer().span("waiting_chat"):
+            resp = self.handle_for_waiting_chat(request_msg)
         if resp:
             return resp
 
@@ -129,51 +190,283 @@ class WechatMsgHandler:
         if resp:
             return resp
 
+        if self.draining:
+            return self.as_response(self.restarting_msg_creator(request_msg))
+
         return self.handle_for_normal_chat(request_msg)
 
+    def drain(self, timeout_seconds: float) -> dict:
+        """Stops sending new questions to the bot, waits up to `timeout_seconds` for the chats in flight, then flushes to files."""
+        self.draining = True
+        deadline = time.time() + timeout_seconds
+        while self.chating_users and time.time() < deadline:
+            time.sleep(0.1)
+        in_flight = len(self.chating_users)
+        get_logger().info(f"drained, {in_flight} chats still in flight.")
+        result = {"drained": in_flight == 0, "in_flight_chats": in_flight}
+        for flush in self.drain_flushes:
+            try:
+                result.update(flush() or {})
+            except Exception:
+                get_logger().error("failed to flush before restart: ", exc_info=True)
+        return result
+
+    def undrain(self):
+        """Sends new questions to the bot again, e.g. when the restart after `drain` was called off."""
+        self.draining = False
+
+    def to_snapshot(self) -> dict:
+        answers = {}
+        for user, msg in list(self.chating_user_answers.items()):
+            if isinstance(msg.content, TextMessageContent):
+                answers[user] = [msg.from_user_name, msg.content.text]
+        return {"answers": answers, "pages": self.pager.to_snapshot()}
+
+    def load_snapshot(self, data: dict):
+        self.chating_user_answers = {user: WechatMsg(user, account, text) for user, (account, text) in data["answers"].items()}
+        self.pager.load_snapshot(data["pages"])
+
     def handle_for_normal_chat(self, request_msg: WechatMsg) -> Response:
         assert isinstance(request_msg.content, TextMessageContent)
         # normal flow
-        self.chating_users[request_msg.from_user_name] = True
-        self.chating_user_asks[request_msg.from_user_name] = request_msg.content.text
+        user = request_msg.from_user_name
+        with self.chat_lock:
+            self.chating_users[user] = True
+            self.chating_user_asks[user] = [request_msg.content.text]
+            self.chating_user_pending_asks[user] = [request_msg.content.text]
+            self.chating_user_next_asks[user] = []
+        return self.handle_chat_turn(request_msg)
+
+    def handle_for_next_turn(self, request_msg: WechatMsg) -> Response:
+        """Waits for the answer in flight, then answers this and the other messages that arrived meanwhile."""
+        user = request_msg.from_user_name
+        deadline = time.time() + self.next_turn_wait_seconds
+        with self.chat_lock:
+            while user in self.chating_user_dispatched:
+                remaining_seconds = deadline - time.time()
+                if remaining_seconds <= 0:
+                    # the thread of the answer in flight answers the next turn when done, the answer is replied on "1"
+                    self.chating_user_next_turn_waiting.discard(user)
+                    get_logger().info(f"waited too long for the answer in flight, the next turn of user {user} is left to the chat.")
+                    return self.as_response(self.wait_timeout_msg_creator(request_msg))
+                self.chat_turn_ended.wait(remaining_seconds)
+            # dropped by the previous turn because the server is draining
+            if request_msg.content.text not in self.chating_user_pending_asks.get(user, []):  # type: ignore
+                return self.as_response(self.restarting_msg_creator(request_msg))
+        return self.handle_chat_turn(request_msg)
+
+    def handle_chat_turn(self, request_msg: WechatMsg) -> Response:
+        user = request_msg.from_user_name
+        self.chating_user_unanswered_replies.pop(user, None)
+        unanswered_reply: Optional[WechatMsg] = None
         try:
-            msg_type, msg_content = self.answer_for_question(request_msg.from_user_name, request_msg.content.text)  # type: ignore
+            with get_tracer().span("merge_window"):
+                self.wait_for_merging_msgs(user)
+            with self.chat_lock:
+                asks = self.chating_user_pending_asks[user]
+                self.chating_user_pending_asks[user] = []
+                draining = self.draining
+                if not draining:
+                    self.chating_user_dispatched.add(user)
+            if draining:
+                # a restart is coming, no new upstream calls
+                unanswered_reply = self.restarting_msg_creator(request_msg)
+                self.chating_user_unanswered_replies[user] = unanswered_reply
+                return self.as_response(unanswered_reply)
+            if len(asks) > 1:
+                get_logger().info(f"merged {len(asks)} messages from user {user} into one question.")
+            msg_type, msg_content = self.answer_or_queue_for_retry(request_msg, "\n".join(asks))
+            if msg_type == "text":
+                msg_content = self.pager.paginate(user, msg_content)
             response_msg = WechatMsg(
                 request_msg.from_user_name,
                 request_msg.to_user_name,
                 msg_content,
                 msg_type=msg_type,
             )
-            self.chating_user_answers[request_msg.from_user_name] = response_msg
+            self.chating_user_answers[user] = response_msg
             return self.as_response(response_msg)
+        except BusyError as e:
+            unanswered_reply = self.msg_creator(request_msg, e.args[0])
+            self.chating_user_unanswered_replies[user] = unanswered_reply
+            return self.as_response(unanswered_reply)
         except Exception as e:
             get_logger().error("Error found: " + str(e), exc_info=True)
             return self.as_response(self.system_error_msg_creator(request_msg))
         finally:
-            self.usage_policy.on_chat(request_msg.from_user_name)
-            del self.chating_users[request_msg.from_user_name]
+            # the question was not answered, it doesn't count against the user's quota
+            if unanswered_reply is None:
+                self.usage_policy.on_chat(user)
+            if self.end_chat_turn(user):
+                self.handle_chat_turn(request_msg)
+
+    def end_chat_turn(self, user: str) -> bool:
+        """Ends a turn of the user's chat, returns True if the calling thread should answer the next turn."""
+        with self.chat_lock:
+            self.chating_user_dispatched.discard(user)
+            next_asks = self.chating_user_next_asks[user]
+            answer_next_turn = False
+            if next_asks and not self.draining:
+                # the chat goes on with the messages arrived meanwhile, answered by the thread of the first one if it
+                # is still waiting, otherwise by this one
+                self.chating_user_asks[user] = list(next_asks)
+                self.chating_user_pending_asks[user] = next_asks
+                self.chating_user_next_asks[user] = []
+                answer_next_turn = user not in self.chating_user_next_turn_waiting
+                self.chating_user_next_turn_waiting.discard(user)
+            else:
+                # when draining, messages waiting for the next turn are dropped, they get the restarting reply
+                del self.chating_users[user]
+                del self.chating_user_pending_asks[user]
+                del self.chating_user_next_asks[user]
+                self.chating_user_next_turn_waiting.discard(user)
+            self.chat_turn_ended.notify_all()
+            return answer_next_turn
+
+    def answer_or_queue_for_retry(self, request_msg: WechatMsg, question: str) -> Tuple[str, str]:
+        user = request_msg.from_user_name
+        if self.retry_queue is None:
+            return self.answer_for_question(user, question)  # type: ignore
+        try:
+            msg_type, msg_content = self.answer_for_question(user, question)
+        except Exception:
+            get_logger().error(f"unable to answer question of user {user}, will retry in background: ", exc_info=True)
+            msg_type, msg_content = "text", None
+        if msg_content is None or msg_content in self.retryable_answers:
+            self.retry_queue.enqueue(user, request_msg.to_user_name, question)
+            return "text", self.retry_queued_msg
+        # the user asked again and got the answer, no need to retry the failed question
+        self.retry_queue.cancel(user)
+        return msg_type, msg_content
+
+    def retry_for_question(self, user: str, account: str, question: str) -> Optional[bool]:
+        """Answers a queued question in the background, the answer is replied when the user sends "1".
+
+        Returns None without asking the bot when draining (the job is kept in the queue file for the next process) or
+        when the user is chatting, which doesn't count as a failed attempt.
+        """
+        with self.chat_lock:
+            if self.draining or user in self.chating_users:
+                return None
+            # a turn of the user's chat like any other, so that new messages wait for it instead of racing on the session
+            self.chating_users[user] = True
+            self.chating_user_asks[user] = [question]
+            self.chating_user_pending_asks[user] = []
+            self.chating_user_next_asks[user] = []
+            self.chating_user_dispatched.add(user)
+        try:
+            msg_type, msg_content = self.answer_for_question(user, question)
+            if msg_content in self.retryable_answers:
+                return False
+            if msg_type == "text":
+                msg_content = self.pager.paginate(user, msg_content)
+            self.chating_user_answers[user] = WechatMsg(user, account, msg_content, msg_type=msg_type)
+            get_logger().info(f"answered queued question of user {user}: {question}")
+            return True
+        finally:
+            if self.end_chat_turn(user):
+                self.handle_chat_turn(WechatMsg(account, user, question))
+
+    def wait_for_merging_msgs(self, user: str):
+        if not self.merge_window_seconds:
+            return
+        msg_count = 1
+        while True:
+            time.sleep(self.merge_window_seconds)
+            with self.chat_lock:
+                if len(self.chating_user_pending_asks[user]) == msg_count:
+                    return
+                msg_count = len(self.chating_user_pending_asks[user])
+
+    def merge_into_chat(self, request_msg: WechatMsg) -> Optional[str]:
+        """Returns None if the user is not chatting, otherwise how the message joins the chat.
+
+        "retry" for a wechat retry or "1", "merged" if it is answered with other messages, "next_turn" if it is the
+        first message arrived while the bot is answering, so it starts the next turn of the chat, "rejected" if there
+        are too many messages waiting already, and "draining" if no new question is taken before a restart.
+        """
+        assert isinstance(request_msg.content, TextMessageContent)
+        user, text = request_msg.from_user_name, request_msg.content.text
+        with self.chat_lock:
+            if user not in self.chating_users:
+                return None
+            if text == "1" or text in self.chating_user_asks[user] or text in self.chating_user_next_asks[user]:
+                return "retry"
+            if self.draining:
+                return "draining"
+            # once a question is sent to the bot, later messages wait for their own turn instead of being merged into it
+            asks = self.chating_user_next_asks[user] if user in self.chating_user_dispatched else self.chating_user_pending_asks[user]
+            if len(asks) >= self.max_merged_msgs:
+                return "rejected"
+            asks.append(text)
+            if asks is self.chating_user_next_asks[user] and len(asks) == 1:
+                # counted when its turn is over
+                self.chating_user_next_turn_waiting.add(user)
+                return "next_turn"
+            if asks is self.chating_user_pending_asks[user]:
+                self.chating_user_asks[user].append(text)
+        self.usage_policy.on_chat(user)
+        return "merged"
+
+    def handle_for_prefiltered_msg(self, request_msg: WechatMsg) -> Optional[Response]:
+        assert isinstance(request_msg.content, TextMessageContent)
+        if self.prefilter is None or request_msg.content.text == "1":
+            return None
+        reply = self.prefilter.filter(request_msg.content.text)
+        if reply is not None:
+            get_logger().info(f"message from user {request_msg.from_user_name} answered by prefilter: {request_msg.content.text}")
+            return self.as_response(self.msg_creator(request_msg, reply))
+        return None
 
     def handle_for_waiting_chat(self, request_msg: WechatMsg) -> Optional[Response]:
         assert isinstance(request_msg.content, TextMessageContent)
         # if there is a waiting message
-        if request_msg.from_user_name in self.chating_users:
-            # if user is asking some other things, just reply that it's too fast.
-            if request_msg.content.text != "1" and request_msg.content.text != self.chating_user_asks.get(request_msg.from_user_name, None):
-                return self.as_response(self.ask_too_fast_msg_creator(request_msg))
-
-            # wechat server send 3 times for response or user typed '1' to get a reply
-            # wait a moment for the answer, if still no, reply a following hint.
-            wait_count = 0
-            while request_msg.from_user_name in self.chating_users:
-                if wait_count >= 3:
-                    get_logger().info("already waited for 3s, will return a pre-defined message.")
-                    return self.as_response(self.wait_timeout_msg_creator(request_msg))
-                time.sleep(1)
-                wait_count += 1
-            return self.as_response(self.chating_user_answers[request_msg.from_user_name])
+        joined = self.merge_into_chat(request_msg)
+        if joined is None:
+            return None
+        # if user is asking too many other things at once, just reply that it's too fast.
+        if joined == "rejected":
+            return self.as_response(self.ask_too_fast_msg_creator(request_msg))
+        if joined == "draining":
+            return self.as_response(self.restarting_msg_creator(request_msg))
+        if joined == "next_turn":
+            return self.handle_for_next_turn(request_msg)
+
+        # wechat server send 3 times for response, user typed '1' to get a reply, or the message is merged into the chat
+        # wait a moment for the answer, if still no, reply a following hint.
+        wait_count = 0
+        while request_msg.from_user_name in self.chating_users:
+            if wait_count >= 3:
+                get_logger().info("already waited for 3s, will return a pre-defined message.")
+                return self.as_response(self.wait_timeout_msg_creator(request_msg))
+            time.sleep(1)
+            wait_count += 1
+        if request_msg.from_user_name in self.chating_user_unanswered_replies:
+            return self.as_response(self.chating_user_unanswered_replies[request_msg.from_user_name])
+        if request_msg.from_user_name not in self.chating_user_answers:
+            return self.as_response(self.system_error_msg_creator(request_msg))
+        return self.as_response(self.chating_user_answers[request_msg.from_user_name])
+
+    def is_command(self, text: str) -> bool:
+        """Whether the message is replied by the server itself: "1", a next page request or a prefiltered message."""
+        return text == "1" or self.pager.is_more_request(text) or (self.prefilter is not None and self.prefilter.matches(text))
+
+    def handle_for_next_page(self, request_msg: WechatMsg) -> Optional[Response]:
+        assert isinstance(request_msg.content, TextMessageContent)
+        if not self.pager.is_more_request(request_msg.content.text):
+            return None
+        page = self.pager.next_page(request_msg.from_user_name)
+        if page is None:
+            return None
+        response_msg = self.msg_creator(request_msg, page)
+        # "1" should give this page again if the reply got lost
+        self.chating_user_answers[request_msg.from_user_name] = response_msg
+        return self.as_response(response_msg)
 
     def handle_for_getting_last_reply(self, request_msg: WechatMsg) -> Optional[Response]:
         assert isinstance(request_msg.content, TextMessageContent)
+        if request_msg.content.text == "1" and self.retry_queue is not None and self.retry_queue.has_job(request_msg.from_user_name):
+            return self.as_response(self.retry_pending_msg_creator(request_msg))
         # if user would like to get the recent reply
         if request_msg.content.text == "1" and request_msg.from_user_name in self.chating_user_answers:
             # This is to resolve a issue with wechat server. If we keep return the same correct msg, wechat will recognize it as an error.
@@ -184,7 +477,8 @@ class WechatMsgHandler:
             return self.as_response(msg)
 
     def answer_for_question(self, user: str, question: str):
-        answer = self.bot.answer(user, question)
+        with get_tracer().span("answer"):
+            answer = self.bot.answer(user, question)
         if isinstance(answer, tuple):
             return answer[0], answer
         return "text", answer.strip()
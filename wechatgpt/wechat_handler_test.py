@@ -1,11 +1,18 @@
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
+from typing import List, Optional
 
 import requests
 
-from wechatgpt.bot import Bot
+from wechatgpt.bot import Bot, BusyError
 
+from .prefilter import MessagePrefilter
+from .testing import SlowMockBot
 from .usage_policy import UsagePolicy
 from .wechat_handler import Request, WechatMsg, WechatMsgHandler, check_signature
 
@@ -87,6 +94,136 @@ class WechatHandlerTest(unittest.TestCase):
         print(resp.content)
 
 
+class MergeMessagesTest(unittest.TestCase):
+    def text_request(self, text: str) -> Request:
+        msg = WechatMsg("wechat-account-1", "wechat-account-2", text)
+        return Request("POST", "/wechat", msg.xml_str())
+
+    def send(self, handler: WechatMsgHandler, text: str, responses: List[str]) -> threading.Thread:
+        def handle():
+            response = handler.handle(self.text_request(text))
+            responses.append(WechatMsg.from_raw_xml(response.body).content.text)  # type: ignore
+
+        thread = threading.Thread(target=handle, daemon=True)
+        thread.start()
+        return thread
+
+    def test_messages_sent_while_answering_are_the_next_turn(self):
+        bot = SlowMockBot()
+        up = UsagePolicy([])
+        handler = WechatMsgHandler(bot, up, "")
+        responses: List[str] = []
+        first = self.send(handler, "我想问", responses)
+        time.sleep(0.1)
+        second = self.send(handler, "怎么学英语", responses)
+        time.sleep(0.05)
+        third = self.send(handler, "有什么建议", responses)
+        for thread in [first, second, third]:
+            thread.join(5)
+        # the answer in flight is kept, later messages are answered together in one more call
+        self.assertEqual(bot.questions, ["我想问", "怎么学英语\n有什么建议"])
+        self.assertEqual(responses, ["answer to 我想问"] + [f"answer to {bot.questions[1]}"] * 2)
+        self.assertEqual(up.user_chat_stat["wechat-account-2"].chat_count, 3)
+        self.assertEqual(handler.chating_users, {})
+
+    def test_next_turn_answered_by_chat_after_wait_timeout(self):
+        bot = SlowMockBot()
+        up = UsagePolicy([])
+        handler = WechatMsgHandler(bot, up, "")
+        handler.next_turn_wait_seconds = 0.1
+        responses: List[str] = []
+        first = self.send(handler, "我想问", responses)
+        time.sleep(0.05)
+        second = self.send(handler, "怎么学英语", responses)
+        second.join(5)
+        self.assertEqual(responses, [handler.wait_timeout_msg_creator(WechatMsg("", "", "")).content.text])  # type: ignore
+        first.join(5)
+        # the thread of the answer in flight answers the next turn, it is replied on "1"
+        self.assertEqual(bot.questions, ["我想问", "怎么学英语"])
+        self.assertEqual(responses[1], "answer to 我想问")
+        self.assertEqual(handler.chating_user_answers["wechat-account-2"].content.text, "answer to 怎么学英语")  # type: ignore
+        self.assertEqual(up.user_chat_stat["wechat-account-2"].chat_count, 2)
+        self.assertEqual(handler.chating_users, {})
+
+    def test_merge_messages_within_window(self):
+        bot = SlowMockBot()
+        handler = WechatMsgHandler(bot, UsagePolicy([]), "", merge_window_ms=100, max_merged_msgs=2)
+        responses: List[str] = []
+        first = self.send(handler, "我想问", responses)
+        time.sleep(0.05)
+        second = self.send(handler, "怎么学英语", responses)
+        time.sleep(0.05)
+        response = handler.handle(self.text_request("有什么建议"))
+        self.assertEqual(WechatMsg.from_raw_xml(response.body).content.text, handler.ask_too_fast_msg_creator(WechatMsg("", "", "")).content.text)  # type: ignore
+        first.join(5)
+        second.join(5)
+        self.assertEqual(bot.questions, ["我想问\n怎么学英语"])
+
+
+class PrefilterTest(unittest.TestCase):
+    def test_prefiltered_msg_not_sent_to_bot(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "prefilter.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"canned_replies": {"你好": "你好呀"}}, f, ensure_ascii=False)
+            bot = SlowMockBot()
+            handler = WechatMsgHandler(bot, UsagePolicy([]), "", prefilter=MessagePrefilter(path))
+            msg = WechatMsg("wechat-account-1", "wechat-account-2", "你好")
+            response = handler.handle(Request("POST", "/wechat", msg.xml_str()))
+            self.assertEqual(WechatMsg.from_raw_xml(response.body).content.text, "你好呀")  # type: ignore
+            self.assertEqual(bot.questions, [])
+
+
+class PaginationTest(unittest.TestCase):
+    def test_more_pages_served_without_bot(self):
+        class LongAnswerBot(SlowMockBot):
+            def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+                self.questions.append(question)
+                return "这是一个很长的句子。" * 150
+
+        bot = LongAnswerBot()
+        handler = WechatMsgHandler(bot, UsagePolicy([]), "")
+
+        def send(text: str) -> str:
+            msg = WechatMsg("wechat-account-1", "wechat-account-2", text)
+            return WechatMsg.from_raw_xml(handler.handle(Request("POST", "/wechat", msg.xml_str())).body).content.text  # type: ignore
+
+        pages = [send("讲个长故事"), send("更多"), send("more")]
+        self.assertEqual(bot.questions, ["讲个长故事"])
+        for page in pages:
+            self.assertLessEqual(len(page.encode("utf-8")), 2000)
+        self.assertIn("第1/3页", pages[0])
+        self.assertIn("第2/3页", pages[1])
+        self.assertTrue(pages[2].endswith("这是一个很长的句子。"))
+        self.assertEqual("".join(p.split("\n\n")[0] for p in pages), "这是一个很长的句子。" * 150)
+        # no more pages, asked as a normal question
+        send("更多")
+        self.assertEqual(bot.questions, ["讲个长故事", "更多"])
+
+
+class BusyReplyTest(unittest.TestCase):
+    def test_busy_reply_not_counted_or_stored(self):
+        class BusyBot(SlowMockBot):
+            def answer(self, user: str, question: str, max_tokens: Optional[int] = None) -> str:
+                self.questions.append(question)
+                if question == "在吗":
+                    raise BusyError("人太多了，请稍后再问")
+                return f"answer to {question}"
+
+        up = UsagePolicy([])
+        handler = WechatMsgHandler(BusyBot(), up, "")
+
+        def send(text: str) -> str:
+            msg = WechatMsg("wechat-account-1", "wechat-account-2", text)
+            return WechatMsg.from_raw_xml(handler.handle(Request("POST", "/wechat", msg.xml_str())).body).content.text  # type: ignore
+
+        self.assertEqual(send("你好"), "answer to 你好")
+        self.assertEqual(send("在吗"), "人太多了，请稍后再问")
+        self.assertEqual(up.user_chat_stat["wechat-account-2"].chat_count, 1)
+        # "1" still gives the last real answer
+        self.assertEqual(handler.chating_user_answers["wechat-account-2"].content.text, "answer to 你好")  # type: ignore
+
+
 class CheckSignatureTest(unittest.TestCase):
     def test_check_signature(self):
         self.assertFalse(check_signature("??", "082573e32ee902b7a7b3833f98e2d4b4a4adc507", "1678200460", "1888015449"))